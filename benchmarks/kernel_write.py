@@ -0,0 +1,92 @@
+# Benchmark of the kernel payload writer against the old string concatenating loaders
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Renders an obj_attr payload of N synthetic objects the way the loaders did before
+payloads were streamed (one string built with += and written at once), through the
+chunked writer alone, through kernel.push, which also fingerprints the payload, and
+through kernel.push to a kernel supporting delta updates, which also keeps a digest
+of every entry for the next delta push. Reports the wall time and peak RSS of each. Every run happens in a
+fresh process, so the peak RSS of one run does not hide the next. Nothing is written
+to the kernel: the old loader writes to /dev/null and the others to a RecordingSink.
+
+    python3 benchmarks/kernel_write.py -n 1000 -n 100000 -n 1000000
+"""
+import os
+import sys
+import time
+import json
+import resource
+import subprocess
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def make_objects(n):
+    return {f"/home/secured/dir{i % 1000}/file{i}": {"dept": f"d{i % 7}", "level": f"l{i % 3}"} for i in range(n)}
+
+def old_loader(objects):
+    """load_obj_attr before the streaming writer"""
+    content = ""
+    for path, avp_dict in objects.items():
+        avps = []
+        for name, value in avp_dict.items():
+            avps.append(f"{name}={value}")
+        if len(avps) == 0:
+            continue
+        content += f"{path}:{','.join(avps)}\n"
+    with open(os.devnull, 'w') as f:
+        f.write(content)
+    return len(content)
+
+def new_loader(objects, delta=False):
+    from src import kernel
+    from src.load import render_obj_attr
+    kernel.set_sink(kernel.RecordingSink(delta=delta, keep_data=False))
+    return kernel.push("obj_attr", lambda: render_obj_attr(objects.items()))
+
+def delta_loader(objects):
+    return new_loader(objects, delta=True)
+
+def writer_only(objects):
+    """The chunked writer alone, without the fingerprint and the digests kept for deltas"""
+    from src import kernel
+    from src.load import render_obj_attr
+    kernel.set_sink(kernel.RecordingSink(delta=False, keep_data=False))
+    writer = kernel.ChunkedWriter("obj_attr")
+    for key, line in render_obj_attr(objects.items()):
+        writer.write(line)
+    return writer.close()
+
+LOADERS = {"old": old_loader, "writer": writer_only, "push": new_loader, "delta": delta_loader}
+
+def run(mode, n):
+    """Runs one loader in this process and prints its measurements as json"""
+    # imported up front, so that their memory is not counted against a loader
+    from src import kernel, load
+    objects = make_objects(n)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    written = LOADERS[mode](objects)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "bytes": written, "base_kb": base_rss, "peak_kb": peak_rss}))
+
+@click.command()
+@click.option('-n', '--objects', 'sizes', type=int, multiple=True, default=[1000, 100000, 1000000], help="Number of objects. Can be repeated.")
+@click.option('--run', 'mode', type=click.Choice(list(LOADERS)), default=None, hidden=True)
+def main(sizes, mode):
+    if mode is not None:
+        run(mode, sizes[0])
+        return
+    print(f"{'objects':>10} {'loader':>6} {'seconds':>9} {'MB written':>11} {'peak RSS MB':>12} {'above data MB':>14}")
+    for n in sizes:
+        for loader in LOADERS:
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", loader, "-n", str(n)],
+                    check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            r = json.loads(out.splitlines()[-1])
+            print(f"{n:>10} {loader:>6} {r['seconds']:>9.3f} {r['bytes'] / 2**20:>11.1f} "
+                    f"{r['peak_kb'] / 1024:>12.1f} {(r['peak_kb'] - r['base_kb']) / 1024:>14.1f}")
+
+if __name__ == "__main__":
+    main()
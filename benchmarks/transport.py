@@ -0,0 +1,89 @@
+# Round trip latency of the attribute server transports
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Compares the round trip latency of a request over the unix socket and over TCP
+localhost. A server process answers every request with the framing of the attribute
+server (server.recv_message and server.send_message), after looking up the peer
+credentials as the server does. The client connects once per request, like 'abac obj'.
+No attribute store or kernel is involved, so only the transport is measured.
+
+    python3 benchmarks/transport.py -n 10000
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import statistics
+import subprocess
+import click
+from multiprocessing.connection import Client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.server import recv_message, send_message, get_peer_uid
+
+async def answer(reader, writer):
+    try:
+        get_peer_uid(writer)
+        msg = await recv_message(reader)
+        send_message(writer, {"status": "OK", "action": msg["action"]})
+        await writer.drain()
+    finally:
+        writer.close()
+
+def serve(socket_path):
+    """Serves socket_path and a TCP port, printed on stdout, until stdin is closed"""
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.start_unix_server(answer, socket_path))
+    tcp = loop.run_until_complete(asyncio.start_server(answer, 'localhost', 0))
+    print(tcp.sockets[0].getsockname()[1], flush=True)
+    loop.add_reader(sys.stdin.fileno(), loop.stop)
+    loop.run_forever()
+
+def round_trips(address, family, n, uid):
+    times = []
+    payload = {"action": "LIST", "object": "/home/secured/file"}
+    if uid:
+        # sent by TCP clients only, as the server can't verify them
+        payload["uid"] = os.geteuid()
+    for _ in range(n):
+        start = time.perf_counter()
+        with Client(address, family=family) as conn:
+            conn.send(payload)
+            conn.recv()
+        times.append(time.perf_counter() - start)
+    return times
+
+def report(name, times):
+    times = sorted(times)
+    us = lambda t: t * 1e6
+    print(f"{name:>6} {us(statistics.mean(times)):>10.1f} {us(times[len(times) // 2]):>10.1f} "
+            f"{us(times[int(len(times) * 0.99)]):>10.1f}")
+
+@click.command()
+@click.option('-n', '--requests', 'n', default=5000, show_default=True, help="Round trips per transport.")
+@click.option('--serve', 'socket_path', default=None, hidden=True)
+def main(n, socket_path):
+    if socket_path is not None:
+        serve(socket_path)
+        return
+    socket_path = os.path.join(tempfile.mkdtemp(), "abac.sock")
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", socket_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        port = int(server.stdout.readline())
+        # warm up both listeners
+        round_trips(socket_path, 'AF_UNIX', 100, False)
+        round_trips(('localhost', port), 'AF_INET', 100, True)
+        print(f"{'':>6} {'mean us':>10} {'p50 us':>10} {'p99 us':>10}")
+        report("unix", round_trips(socket_path, 'AF_UNIX', n, False))
+        report("tcp", round_trips(('localhost', port), 'AF_INET', n, True))
+    finally:
+        server.stdin.close()
+        server.wait()
+        os.remove(socket_path)
+
+if __name__ == "__main__":
+    main()
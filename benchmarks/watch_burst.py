@@ -0,0 +1,107 @@
+# Benchmark of the shared directory watcher on a burst of create events
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Creates a tree of N files in a temporary shared directory, like extracting a tarball,
+and replays one created event per file and directory through the watcher's Handler,
+timing until its queue is drained. The watcher used to run 'chmod -R' on the whole
+shared directory for every created event. That is timed on the first --old-sample
+events and extrapolated to the burst, as running it N times takes too long.
+The Handler uses a temporary json store, and kernel reloads are only counted.
+
+    python3 benchmarks/watch_burst.py -n 100000
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import click
+from watchdog.events import FileCreatedEvent, DirCreatedEvent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src import store, watch
+from src.config import SHARED_DIR_MODE
+
+class CountingReloads:
+    """Stands in for the ReloadScheduler, so that no kernel is needed"""
+
+    def __init__(self):
+        self.requests = 0
+
+    def request(self):
+        self.requests += 1
+
+def make_store(root):
+    files = {
+        "user_attr.json": {"users": {}},
+        "obj_attr.json": {"objects": {}},
+        "dir_attr.json": {"dirs": {}},
+        "avp.json": {"user": {}, "obj": {}, "env": {}},
+        "policy.json": {"rules": []},
+    }
+    for name, content in files.items():
+        with open(os.path.join(root, name), "w") as f:
+            json.dump(content, f)
+    return store.JSONStore(root + "/")
+
+def make_tree(share, n, per_dir):
+    """Creates n files, per_dir of them per directory. Returns the events of their creation"""
+    events = []
+    for i in range(n):
+        if i % per_dir == 0:
+            d = os.path.join(share, f"dir{i // per_dir}")
+            os.mkdir(d)
+            events.append(DirCreatedEvent(d))
+        path = os.path.join(d, f"file{i}")
+        open(path, "w").close()
+        events.append(FileCreatedEvent(path))
+    return events
+
+def reset_modes(share):
+    for root, dirs, files in os.walk(share):
+        os.chmod(root, 0o755)
+        for name in files:
+            os.chmod(os.path.join(root, name), 0o644)
+
+@click.command()
+@click.option('-n', '--files', 'n', default=100000, show_default=True, help="Number of files created by the burst.")
+@click.option('--per-dir', default=1000, show_default=True, help="Files per directory.")
+@click.option('--old-sample', default=20, show_default=True, help="Events replayed with 'chmod -R' to extrapolate the old watcher.")
+def main(n, per_dir, old_sample):
+    tmp = tempfile.mkdtemp()
+    share = os.path.join(tmp, "share")
+    os.mkdir(share)
+    try:
+        store.store = make_store(tmp)
+        watch.watch_dir = share
+        events = make_tree(share, n, per_dir)
+        print(f"{len(events)} created events, {n} files in {len(events) - n} directories")
+
+        reset_modes(share)
+        reloads = CountingReloads()
+        handler = watch.Handler(reloads)
+        start = time.perf_counter()
+        for event in events:
+            handler.on_any_event(event)
+        handler.events.join()
+        elapsed = time.perf_counter() - start
+        wrong = sum(1 for root, dirs, files in os.walk(share) for name in files
+                if os.stat(os.path.join(root, name)).st_mode & 0o7777 != SHARED_DIR_MODE)
+        print(f"watcher : {elapsed:.2f}s, {len(events) / elapsed:.0f} events/s, {reloads.requests} reloads requested, "
+                f"{wrong} files left with the wrong mode")
+
+        reset_modes(share)
+        start = time.perf_counter()
+        for event in events[:old_sample]:
+            subprocess.run(["chmod", "-R", oct(SHARED_DIR_MODE)[2:], share], check=True)
+        per_event = (time.perf_counter() - start) / old_sample
+        print(f"chmod -R: {per_event * 1000:.1f}ms per event, about {per_event * len(events):.0f}s for the burst")
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main()
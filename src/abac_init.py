@@ -35,6 +35,7 @@ def init(force):
     /etc/abac/                  - root config directory
     /etc/abac/user_attr.json    - ABAC User attributes
     /etc/abac/obj_attr          - ABAC Object attributes
+    /etc/abac/dir_attr.json     - ABAC attributes inherited from directories
     /etc/abac/policy            - ABAC Policy attributes
     /etc/abac/avp.json          - Valid Object attribute value pairs
     """
@@ -53,12 +54,22 @@ def init(force):
         #chmod 660 = only root can read/write to this directory and its contents
         os.chmod(CONFIG_ROOT, 0o660)
 
+    # the json files below are the store again, drop the migrated database
+    # and the journal of updates to the old object attributes
+    if force:
+        for name in [CONFIG_DB_FILE, CONFIG_OBJ_JOURNAL_FILE]:
+            if Path(CONFIG_ROOT + name).is_file():
+                os.remove(CONFIG_ROOT + name)
+
     # create the user attributes file
     create_file(CONFIG_ROOT + CONFIG_USER_ATTRS_FILE, force, "User attributes file already exists", {"users": {}})
 
     # create the object attributes file
     create_file(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE, force, "Object attributes file already exists", {"objects": {}})
 
+    # create the directory attributes file
+    create_file(CONFIG_ROOT + CONFIG_DIR_ATTRS_FILE, force, "Directory attributes file already exists", {"dirs": {}})
+
     # create the kernel attributes file
     create_file(CONFIG_ROOT + CONFIG_ENV_ATTRS_FILE, force, "Environment attributes file already exists", {"env": {}})
 
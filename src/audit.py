@@ -0,0 +1,90 @@
+# ABAC audits
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+import sys
+import struct
+import click
+from .common import check_root, get_env_attrs, parse_avps
+from .store import get_store
+from .engine import OPS, AccessMatrix, bit_indices
+from .inherit import effective_objs
+
+# magic of the binary access matrix format
+MATRIX_MAGIC = b"ABACMTX1"
+# bound on the number of lists of allowed users kept in memory
+USERS_CACHE_SIZE = 65536
+
+def write_csv(out, matrix, objects, ops):
+    """One 'user,object,op' line per allowed access"""
+    names = [username for username, _ in matrix.users]
+    # lines of the users allowed on the last seen attribute combinations
+    users_cache = {}
+    out.write(b"user,object,op\n")
+    for path, avps in objects:
+        path = path.encode()
+        if b"," in path or b'"' in path:
+            path = b'"' + path.replace(b'"', b'""') + b'"'
+        for op in ops:
+            bits = matrix.allowed(avps, op)
+            if bits == 0:
+                continue
+            allowed = users_cache.get(bits)
+            if allowed is None:
+                allowed = [names[i].encode() for i in bit_indices(bits)]
+                if len(users_cache) >= USERS_CACHE_SIZE:
+                    users_cache.clear()
+                users_cache[bits] = allowed
+            suffix = b"," + path + b"," + op.encode() + b"\n"
+            out.write(b"".join(name + suffix for name in allowed))
+
+def write_binary(out, matrix, objects, ops):
+    """
+    Header: magic, number of users, then uid, name length and name of every user.
+    Records: op index, path length, path and the bitset of the allowed users,
+    little endian, one bit per user in header order
+    """
+    size = (len(matrix.users) + 7) // 8
+    out.write(MATRIX_MAGIC)
+    out.write(struct.pack("<I", len(matrix.users)))
+    for username, data in matrix.users:
+        name = username.encode()
+        out.write(struct.pack("<IH", data["uid"], len(name)) + name)
+    for path, avps in objects:
+        path = path.encode()
+        for op in ops:
+            bits = matrix.allowed(avps, op)
+            out.write(struct.pack("<BH", OPS.index(op), len(path)) + path + bits.to_bytes(size, 'little'))
+
+@click.command()
+@click.option('-f', '--format', 'fmt', type=click.Choice(['csv', 'binary']), default='csv', help="Output format.")
+@click.option('-o', '--output', 'output', type=click.Path(dir_okay=False), default=None, help="Write to this file instead of stdout.")
+@click.option('--op', 'op', type=click.Choice(['READ', 'MODIFY', 'ALL'], case_sensitive=False), default='ALL', help="Operation to audit.")
+@click.option('-e', '--env', 'env', multiple=True, help="Evaluate with this environment attribute-value pair (attr=value) instead of the current one. Can be repeated.")
+@click.argument('action', type=click.Choice(['matrix']))
+def audit(action, fmt, output, op, env):
+    """\b
+    Audit ABAC access. YOU MUST BE ROOT TO USE THIS COMMAND
+    The following actions are supported.
+    matrix  - Every user against every object with attributes, for READ and MODIFY,
+              under the current environment attributes.
+              csv    - one 'user,object,op' line per allowed access
+              binary - one record per object and op holding a bitset of the allowed users"""
+    check_root()
+
+    store = get_store()
+    env_avps = get_env_attrs()
+    env_avps.update(parse_avps(env))
+    ops = OPS if op.upper() == "ALL" else [op.upper()]
+
+    matrix = AccessMatrix(list(store.iter_users()), store.get_rules(), env_avps)
+    out = open(output, "wb") if output is not None else sys.stdout.buffer
+    try:
+        if fmt == "csv":
+            write_csv(out, matrix, effective_objs(store), ops)
+        else:
+            write_binary(out, matrix, effective_objs(store), ops)
+    finally:
+        if output is not None:
+            out.close()
+        else:
+            out.flush()
@@ -1,12 +1,14 @@
 # ABAC attribute-value pair management
 # Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
 
-import json
 import click
 import sys
 from pathlib import Path
 from .common import check_root, validate_str
 from .config import CONFIG_ROOT, CONFIG_AVP_FILE
+from .store import get_store
+from .load import load_user_attr, load_obj_attr, load_policy
+from .policy import print_rule
 
 avp_path = CONFIG_ROOT + CONFIG_AVP_FILE 
 
@@ -21,8 +23,7 @@ def print_avps(avps):
         print(f"[{i}] {name}: {', '.join(values)}")
 
 def add_attr(type_):
-    with open(avp_path) as f:
-        data = json.load(f)
+    data = get_store().get_avps()
     print_avps(data[type_])
     name = input("Enter new attribute name: ")
     if not validate_str(name):
@@ -39,28 +40,105 @@ def add_attr(type_):
             sys.exit("One of the values is invalid. Values must be alpha numeric")
         values.append(value)
     data[type_][name] = values
-    with open(avp_path, 'w') as f:
-        json.dump(data, f)
+    get_store().set_avps(data)
     print(f"New attribute-value pair {name}:{', '.join(values)} added successfully")
 
 def list_attr(type_):
-    with open(avp_path) as f:
-        if type_:
-            avps = json.load(f)[type_]
-            print_avps(avps)
+    avps = get_store().get_avps()
+    if type_:
+        print_avps(avps[type_])
+    else:
+        print("User Attribute-value pairs\n")
+        print_avps(avps["user"])
+        print("\nObject Attribute-value pairs\n")
+        print_avps(avps["obj"])
+        print("\nEnvironment Attribute-value pairs\n")
+        print_avps(avps["env"])
+        print()
+
+def find_dependents(type_, name, values, rules):
+    """
+    The users (type user) or objects (type obj) holding name with one of the values,
+    the directories (type obj) whose inherited attributes hold it, and the indices of
+    the rules using them. On SQLite, users and objects are looked up through the
+    attribute indexes of the store, in time proportional to the number of dependents.
+    The JSON store scans its objects. Directories and rules are scanned on both
+    """
+    store = get_store()
+    entities = {}
+    dirs = {}
+    for value in values:
+        if type_ == "user":
+            entities.update(store.users_with(name, value))
+        else:
+            entities.update(store.objs_with(name, value))
+    if type_ == "obj":
+        dirs = {path: avps for path, avps in store.get_dirs().items() if avps.get(name) in values}
+    indices = [i for i, rule in enumerate(rules) if rule[type_].get(name) in values]
+    return entities, dirs, indices
+
+def apply_dependents(type_, name, values, cascade):
+    """
+    Report the users, objects and rules using name with one of the values. With cascade,
+    remove the attribute from those users or objects and delete those rules, reloading
+    each affected kernel file once. Without it, abort if there are any
+    """
+    store = get_store()
+    rules = store.get_rules()
+    entities, dirs, rule_indices = find_dependents(type_, name, values, rules)
+    if len(entities) == 0 and len(dirs) == 0 and len(rule_indices) == 0:
+        return
+    kind = "users" if type_ == "user" else "objects"
+    if type_ == "obj":
+        kind += f", {len(dirs)} directories"
+    print(f"{len(entities)} {kind} and {len(rule_indices)} rules use {name}={'|'.join(values)}")
+    for key, data in entities.items():
+        avps = data["avps"] if type_ == "user" else data
+        print(f"{key}: {name}={avps[name]}")
+    for path, avps in dirs.items():
+        print(f"{path} (directory): {name}={avps[name]}")
+    for i in rule_indices:
+        print(f"[{i}] {print_rule(rules[i])}")
+    if not cascade:
+        sys.exit("Aborted. Use --cascade to remove the attribute from these and delete these rules")
+
+    if type_ == "user":
+        updates = {}
+        for username, data in entities.items():
+            avps = {n: v for n, v in data["avps"].items() if n != name}
+            updates[username] = {"uid": data["uid"], "avps": avps}
+        store.update_users(updates)
+    else:
+        updates = {}
+        for path, avps in entities.items():
+            # objects left without attributes are removed
+            updates[path] = {n: v for n, v in avps.items() if n != name}
+        store.update_objs(updates)
+        for path, avps in dirs.items():
+            # directories left without attributes are removed
+            store.set_dir(path, {n: v for n, v in avps.items() if n != name})
+    if len(rule_indices) != 0:
+        removed = set(rule_indices)
+        store.set_rules([rule for i, rule in enumerate(rules) if i not in removed])
+    print(f"Attribute removed from {len(entities)} {kind}, {len(rule_indices)} rules deleted")
+    # the objects below the directories inherited the attribute, so they are reloaded too
+    return len(entities) != 0 or len(dirs) != 0, len(rule_indices) != 0
+
+def reload_dependents(type_, changed):
+    """Reload the kernel files of the entities, directories and rules changed by apply_dependents"""
+    if changed is None:
+        return
+    entities, rules = changed
+    if entities:
+        if type_ == "user":
+            load_user_attr()
         else:
-            avps = json.load(f)
-            print("User Attribute-value pairs\n")
-            print_avps(avps["user"])
-            print("\nObject Attribute-value pairs\n")
-            print_avps(avps["obj"])
-            print("\nEnvironment Attribute-value pairs\n")
-            print_avps(avps["env"])
-            print()
-
-def modify_attr(type_):
-    with open(avp_path) as f:
-        data = json.load(f)
+            load_obj_attr()
+    if rules:
+        load_policy()
+
+def modify_attr(type_, cascade=False):
+    data = get_store().get_avps()
     print_avps(data[type_])
     name = input("Name of the attribute to modify: ")
     if name not in data[type_]:
@@ -75,29 +153,32 @@ def modify_attr(type_):
         if not validate_str(value):
             sys.exit("One of the values is invalid. Values must be alpha numeric")
         values.append(value)
+    removed = [value for value in data[type_][name] if value not in values]
+    changed = apply_dependents(type_, name, removed, cascade)
     data[type_][name] = values
-    with open(avp_path, 'w') as f:
-        json.dump(data, f)
+    get_store().set_avps(data)
     print(f"Attribute-value pair {name}:{', '.join(values)} modified successfully")
+    reload_dependents(type_, changed)
 
 
-def delete_attr(type_):
-    with open(avp_path) as f:
-        data = json.load(f)
+def delete_attr(type_, cascade=False):
+    data = get_store().get_avps()
     print_avps(data[type_])
     name = input("Name of the attribute-value pair to delete: ")
     if name not in data[type_]:
         sys.exit(f"attribute {name} not found")
     values = data[type_][name]
+    changed = apply_dependents(type_, name, values, cascade)
     del data[type_][name]
-    with open(avp_path, 'w') as f:
-        json.dump(data, f)
+    get_store().set_avps(data)
     print(f"attribute-value pair {name}:{','.join(values)} deleted successfully")
+    reload_dependents(type_, changed)
 
 @click.command()
 @click.option('-t', 'type_', type=click.Choice(['user', 'obj', 'env']), help="Type of the entity")
+@click.option('--cascade', 'cascade', default=False, is_flag=True, help="modify, delete: remove the deleted values from the users, objects or directories holding them, and delete the rules using them.")
 @click.argument('action', type=click.Choice(['add', 'list', 'delete', 'modify']))
-def avp(action, type_):
+def avp(action, type_, cascade):
     """\b
     Manage User and Object attribute-value pairs. 
     YOU MUST BE ROOT TO USE THIS ACTIONS OTHER THAN 'list'.
@@ -105,7 +186,10 @@ def avp(action, type_):
     add     - Add a new attribute and its possible values
     list    - List existing attribute-value pairs
     modify  - Modify the values of an existing attribute
-    delete  - Delete an attribute-value pair"""
+    delete  - Delete an attribute-value pair
+    modify and delete refuse to remove values still held by users, objects or
+    directories or used by rules, and list them. With --cascade, the attribute is
+    removed from them and the rules are deleted."""
 
     check_root()
     check_avp()
@@ -119,6 +203,6 @@ def avp(action, type_):
     if action == "add":
         add_attr(type_)
     elif action == "modify":
-        modify_attr(type_)
+        modify_attr(type_, cascade)
     elif action == "delete":
-        delete_attr(type_)
+        delete_attr(type_, cascade)
@@ -0,0 +1,63 @@
+# ABAC access check
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+import sys
+import click
+from pathlib import Path
+from .config import SHARED_DIR
+from .common import check_root, get_env_attrs, parse_avps
+from .store import get_store
+from .engine import PolicyEngine
+from .inherit import effective_obj
+from .policy import print_rule
+
+def find_user(user):
+    """Look up a user by name, or by uid if user is numeric"""
+    store = get_store()
+    data = store.get_user(user)
+    if data is not None:
+        return user, data
+    if user.isnumeric():
+        return store.user_by_uid(int(user))
+    return None
+
+@click.command()
+@click.option('-e', '--env', 'env', multiple=True, help="Evaluate with this environment attribute-value pair (attr=value) instead of the current one. Can be repeated.")
+@click.argument('user', type=str)
+@click.argument('object_path', type=str)
+@click.argument('op', type=click.Choice(['READ', 'MODIFY', 'R', 'M'], case_sensitive=False))
+def check(user, object_path, op, env):
+    """\b
+    Check if the ABAC policy allows USER (name or uid) to READ or MODIFY the object at
+    OBJECT_PATH, with the current user, object and environment attributes.
+    YOU MUST BE ROOT TO USE THIS COMMAND. Exits with status 1 if access is denied."""
+    check_root()
+
+    op = op.upper()
+    op = {"R": "READ", "M": "MODIFY"}.get(op, op)
+    object_path = str(Path(object_path).resolve())
+    secured_dir_path = str(Path(SHARED_DIR))
+    if object_path[:len(secured_dir_path)] != secured_dir_path:
+        sys.exit(f"Only files in the {SHARED_DIR} are covered by ABAC rules")
+
+    found = find_user(user)
+    if found is None:
+        sys.exit(f"User {user} doesn't have any attributes")
+    username, data = found
+    obj_avps = effective_obj(get_store(), object_path)
+    env_avps = get_env_attrs()
+    env_avps.update(parse_avps(env))
+
+    print(f"User  : {username} ({data['uid']}) {', '.join(f'{n}={v}' for n, v in data['avps'].items())}")
+    print(f"Object: {object_path} {', '.join(f'{n}={v}' for n, v in obj_avps.items())}")
+    print(f"Env   : {', '.join(f'{n}={v}' for n, v in env_avps.items())}")
+
+    rules = get_store().get_rules()
+    engine = PolicyEngine(rules)
+    matches = engine.matching_rules(data["avps"], obj_avps, env_avps, op)
+    if len(matches) == 0:
+        print(f"DENY: no rule allows {username} to {op} {object_path}")
+        sys.exit(1)
+    print(f"ALLOW: {username} can {op} {object_path}. Granted by")
+    for i in matches:
+        print(f"[{i}] {print_rule(rules[i])}")
@@ -3,6 +3,9 @@
 
 import os
 import sys
+import csv
+import json
+from .config import CONFIG_ROOT, CONFIG_ENV_ATTRS_FILE
 
 def check_root():
     # check if user is root
@@ -13,3 +16,60 @@ def validate_str(string):
     # valid string must be alphanumeric strings without spaces
     # this validation applies to usernames, attribute names and attribute values
     return string != None and string != "" and ' ' not in string and string.isalnum()
+
+def get_env_attrs():
+    with open(CONFIG_ROOT + CONFIG_ENV_ATTRS_FILE) as f:
+        return json.load(f)["env"]
+
+def parse_avps(avps):
+    """parse a list of 'attr=value' strings into a dict"""
+    parsed = {}
+    for avp in avps:
+        if avp.count("=") != 1:
+            sys.exit(f"Invalid attribute-value pair {avp}. Expected attr=value")
+        name, value = avp.split("=")
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+def read_records(path):
+    """
+    Stream the records of a JSON lines file, or of a CSV file with a header row if path
+    ends with .csv. Yields (line number, record dict, error). record is None if the line
+    could not be parsed, with the reason in error
+    """
+    with open(path, newline='') as f:
+        if path.lower().endswith(".csv"):
+            reader = csv.DictReader(f)
+            for row in reader:
+                if None in row or None in row.values():
+                    yield reader.line_num, None, f"expected {len(reader.fieldnames)} columns"
+                    continue
+                yield reader.line_num, row, None
+            return
+        for line_number, line in enumerate(f, 1):
+            if line.strip() == "":
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"invalid json: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, "expected a json object"
+                continue
+            yield line_number, record, None
+
+def parse_csv_avps(column):
+    """attr=value pairs of a CSV column, separated by '^'. Empty or '*' is no pairs"""
+    avps = {}
+    column = column.strip()
+    if column in ("", "*"):
+        return avps
+    for avp in column.split("^"):
+        if avp.count("=") != 1:
+            raise ValueError(f"invalid attribute-value pair '{avp.strip()}'")
+        name, value = avp.split("=")
+        if name.strip() in avps:
+            raise ValueError(f"attribute {name.strip()} repeated")
+        avps[name.strip()] = value.strip()
+    return avps
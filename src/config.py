@@ -14,6 +14,19 @@ CONFIG_OBJ_ATTRS_FILE = "obj_attr.json"
 CONFIG_ENV_ATTRS_FILE = "env_attr.json"
 CONFIG_POLICY_FILE = "policy.json"
 CONFIG_AVP_FILE = "avp.json"
+# attributes assigned to directories, inherited by everything below them
+CONFIG_DIR_ATTRS_FILE = "dir_attr.json"
+# owners of the objects with attributes seen by the last 'abac reconcile'
+CONFIG_OWNERS_FILE = "obj_owners.json"
+# SQLite database used instead of the json files above by the sqlite store backend
+CONFIG_DB_FILE = "abac.db"
+# append-only journal of object attribute updates and the lock guarding it (json backend)
+CONFIG_OBJ_JOURNAL_FILE = "obj_attr.journal"
+CONFIG_OBJ_LOCK_FILE = "obj_attr.lock"
+# fingerprints of the payloads currently loaded into the kernel
+CONFIG_FINGERPRINT_FILE = "kernel_fingerprints.json"
+# held while a payload is pushed into the kernel and its fingerprint saved
+CONFIG_FINGERPRINT_LOCK_FILE = "kernel_fingerprints.lock"
 
 KERN_USER_ATTRS_FILE = "user_attr"
 KERN_OBJ_ATTRS_FILE = "obj_attr"
@@ -21,5 +34,68 @@ KERN_ENV_ATTRS_FILE = "env_attr"
 KERN_POLICY_FILE = "policy"
 
 SHARED_DIR = "/home/secured/"
+# mode of the shared directory and everything created in it (setgid, sticky, rwxrwx---)
+SHARED_DIR_MODE = 0o3770
 
+# attribute and policy store backend: "json", "sqlite" or "auto".
+# auto uses sqlite once the json config has been migrated with 'abac migrate'
+STORE_BACKEND = "auto"
+
+# with the json backend, object attribute updates are appended to a journal instead of
+# rewriting obj_attr.json. The journal is folded into obj_attr.json once it grows past
+# OBJ_JOURNAL_COMPACT_SIZE bytes.
+OBJ_JOURNAL_ENABLED = True
+OBJ_JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+
+# changes on every boot. Used to invalidate fingerprints of payloads loaded before a reboot
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+
+# the attribute server listens on this unix socket. Requests on it are attributed to the
+# uid of the connecting process, as reported by the kernel. TCP on PORT is opt-in.
+SERVER_SOCKET = "/run/abac/abac.sock"
 PORT = 4848
+# number of objects sent to the attribute server per BULK_UPDATE by 'abac obj add -r/--from-file'
+OBJ_BULK_BATCH_SIZE = 1000
+# messages larger than this are rejected by the attribute server
+SERVER_MAX_MSG_SIZE = 64 * 1024 * 1024
+
+# object updates arriving within RELOAD_WINDOW seconds of each other are loaded into
+# the kernel by a single reload, which is delayed by at most RELOAD_MAX_LATENCY seconds
+RELOAD_WINDOW = 0.05
+RELOAD_MAX_LATENCY = 0.5
+
+# the kernel accepts incremental updates through a file named after the full
+# payload file with this suffix (eg: obj_attr_delta). Each line is either
+# "+<entry>" to add or replace an entry or "-<key>" to remove one. If the
+# delta file is not exposed by the kernel, full payloads are written instead.
+KERN_DELTA_SUFFIX = "_delta"
+# full payload written to clear a kernel file once the store holds no entries for it.
+# The kernel replaces the file with the (empty) list of entries of a blank line
+EMPTY_PAYLOAD = b"\n"
+
+# payloads are written to the kernel in chunks of (at most) this many bytes.
+# Chunks always end on a line boundary, unless a single line is larger.
+KERN_WRITE_CHUNK_SIZE = 64 * 1024
+# payloads are rendered completely before they are written to the kernel. Rendered
+# payloads larger than this many bytes are spooled to a temporary file instead of memory
+KERN_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# when enabled, load_policy drops duplicate rules and rules subsumed by a more general
+# rule with the same op, and writes the remaining rules to the kernel ordered from the
+# least to the most selective. The policy in the store is left untouched.
+POLICY_MINIMIZE = False
+
+# number of accounts created in parallel by 'abac user import', and the number of
+# attempts of a useradd failing because another one holds the passwd/group file lock
+USER_IMPORT_WORKERS = 4
+USER_IMPORT_RETRIES = 5
+
+# events of the shared directory watcher waiting to be processed. The watcher stops
+# reading filesystem events while the queue is full
+WATCH_QUEUE_SIZE = 10000
+# at most this many queued events are processed together. The object attributes
+# deleted or moved by a batch are written to the store at once, with one kernel reload
+WATCH_BATCH_SIZE = 1000
+
+# number of directories of the shared directory listed in parallel by 'abac reconcile'
+RECONCILE_WORKERS = 8
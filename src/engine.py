@@ -0,0 +1,299 @@
+# ABAC userspace policy decision engine
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Evaluates the ABAC policy in userspace, with the semantics of the rules loaded by
+load_policy: a rule grants its operation if the user holds every user attribute-value
+pair of the rule, the object holds every object pair and the environment matches
+every environment pair. A rule without environment pairs ('*') matches any environment.
+"""
+
+from itertools import combinations
+
+OPS = ["READ", "MODIFY"]
+KINDS = ["user", "obj", "env"]
+# bound on the number of object attribute combinations cached by an AccessMatrix
+SIGNATURE_CACHE_SIZE = 65536
+
+def rule_key(rule):
+    """Canonical, hashable form of a rule. Equal rules have equal keys"""
+    return (frozenset(rule["user"].items()), frozenset(rule["obj"].items()),
+            frozenset(rule["env"].items()), rule["op"])
+
+class PolicyEngine:
+    """
+    Compiled policy. An inverted index maps every (op, kind, attribute, value) to the
+    rules containing it, so a decision only counts the pairs of the candidate rules
+    sharing at least one pair with the request, instead of scanning every rule.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.index = {}
+        # number of attribute-value pairs a request must match for each rule
+        self.sizes = []
+        for i, rule in enumerate(rules):
+            size = 0
+            for kind in KINDS:
+                for attr, value in rule[kind].items():
+                    self.index.setdefault((rule["op"], kind, attr, value), []).append(i)
+                    size += 1
+            self.sizes.append(size)
+
+    def matching_rules(self, user_avps, obj_avps, env_avps, op):
+        """Indices of the rules granting op to a user and object with the given attributes"""
+        counts = {}
+        for kind, avps in zip(KINDS, [user_avps, obj_avps, env_avps]):
+            for attr, value in avps.items():
+                for i in self.index.get((op, kind, attr, value), []):
+                    counts[i] = counts.get(i, 0) + 1
+        return sorted(i for i, count in counts.items() if count == self.sizes[i])
+
+    def is_allowed(self, user_avps, obj_avps, env_avps, op):
+        return len(self.matching_rules(user_avps, obj_avps, env_avps, op)) > 0
+
+def env_matches(rule_env, env_avps):
+    """True if every environment pair of the rule holds in env_avps. Empty ('*') matches all"""
+    for attr, value in rule_env.items():
+        if env_avps.get(attr) != value:
+            return False
+    return True
+
+class AttrBitsets:
+    """
+    Bitsets over a list of entities (users or objects): bit i of the bitset of an
+    attribute-value pair is set if entity i holds that pair. Sets of entities holding
+    all pairs of a rule are computed with a few big integer ANDs.
+    """
+
+    def __init__(self, entities):
+        """entities is a list of avps dicts"""
+        self.count = len(entities)
+        self.all = (1 << self.count) - 1
+        size = (self.count + 7) // 8
+        bitmaps = {}
+        for i, avps in enumerate(entities):
+            for pair in avps.items():
+                if pair not in bitmaps:
+                    bitmaps[pair] = bytearray(size)
+                bitmaps[pair][i >> 3] |= 1 << (i & 7)
+        self.bits = {pair: int.from_bytes(bitmap, 'little') for pair, bitmap in bitmaps.items()}
+
+    def satisfying(self, avps):
+        """Bitset of the entities holding every pair in avps"""
+        bits = self.all
+        for pair in avps.items():
+            bits &= self.bits.get(pair, 0)
+            if bits == 0:
+                break
+        return bits
+
+def bit_indices(bits):
+    """Indices of the set bits, lowest first"""
+    indices = []
+    i = 0
+    while bits:
+        # skip whole zero bytes at a time
+        if bits & 0xff == 0:
+            bits >>= 8
+            i += 8
+            continue
+        if bits & 1:
+            indices.append(i)
+        bits >>= 1
+        i += 1
+    return indices
+
+class AccessMatrix:
+    """
+    Access of every user to objects, one operation at a time. Users are encoded as
+    attribute bitsets, so the users a rule grants access to are found with a few big
+    integer ANDs, and the users allowed on an object are the OR of the bitsets of the
+    rules matching the object. Objects with the same attribute-value pairs share the
+    result, so the rules are only matched once per combination of object attributes.
+    """
+
+    def __init__(self, users, rules, env_avps, bitsets=None):
+        """users is a list of (username, data). bitsets are the AttrBitsets of the users, if already built"""
+        self.users = users
+        if bitsets is None:
+            bitsets = AttrBitsets([data["avps"] for _, data in users])
+        self.bitsets = bitsets
+        # per op: bitset of the users granted by each rule and an index of the
+        # object pairs of the rules, restricted to the rules the environment satisfies
+        self.grants = {}
+        self.index = {}
+        self.sizes = {}
+        for op in OPS:
+            self.grants[op] = []
+            self.index[op] = {}
+            self.sizes[op] = []
+        for rule in rules:
+            if not env_matches(rule["env"], env_avps):
+                continue
+            op = rule["op"]
+            users_bits = bitsets.satisfying(rule["user"])
+            if users_bits == 0:
+                continue
+            i = len(self.grants[op])
+            self.grants[op].append(users_bits)
+            self.sizes[op].append(len(rule["obj"]))
+            for pair in rule["obj"].items():
+                self.index[op].setdefault(pair, []).append(i)
+        self.cache = {op: {} for op in OPS}
+
+    def allowed(self, obj_avps, op):
+        """Bitset of the users allowed op on an object with the given attributes"""
+        signature = frozenset(obj_avps.items())
+        cache = self.cache[op]
+        bits = cache.get(signature)
+        if bits is not None:
+            return bits
+        counts = {}
+        for pair in signature:
+            for i in self.index[op].get(pair, []):
+                counts[i] = counts.get(i, 0) + 1
+        bits = 0
+        for i, count in counts.items():
+            if count == self.sizes[op][i]:
+                bits |= self.grants[op][i]
+        if len(cache) >= SIGNATURE_CACHE_SIZE:
+            cache.clear()
+        cache[signature] = bits
+        return bits
+
+def access_delta(old_rules, new_rules, users, objects, env_avps):
+    """
+    Yields (granted, username, path, op) for every access granted (granted True) or
+    revoked (granted False) by replacing old_rules with new_rules. users is a list of
+    (username, data) and objects an iterable of (path, avps).
+    Only the rules added or removed are matched against every object. The unchanged
+    rules are only evaluated for the objects and users those rules match, since the
+    access of every other (user, object) pair is the same under both policies.
+    """
+    old_keys = {rule_key(rule) for rule in old_rules}
+    new_keys = {rule_key(rule) for rule in new_rules}
+    added = [rule for rule in new_rules if rule_key(rule) not in old_keys]
+    removed = [rule for rule in old_rules if rule_key(rule) not in new_keys]
+    if len(added) == 0 and len(removed) == 0:
+        return
+    unchanged = [rule for rule in new_rules if rule_key(rule) in old_keys]
+    added = AccessMatrix(users, added, env_avps)
+    removed = AccessMatrix(users, removed, env_avps, added.bitsets)
+    unchanged = AccessMatrix(users, unchanged, env_avps, added.bitsets)
+    names = [username for username, _ in users]
+    for path, avps in objects:
+        for op in OPS:
+            granted = added.allowed(avps, op)
+            revoked = removed.allowed(avps, op)
+            if granted == 0 and revoked == 0:
+                continue
+            kept = unchanged.allowed(avps, op)
+            for i in bit_indices(granted & ~revoked & ~kept):
+                yield True, names[i], path, op
+            for i in bit_indices(revoked & ~granted & ~kept):
+                yield False, names[i], path, op
+
+# every rule is indexed under this many of its rarest pairs, and looks up the subsets
+# of its pairs of at most this size. A rule of k pairs makes about k^MAX_SUBSET_PAIRS
+# lookups, and compares itself with the smaller rules indexed under them
+MAX_SUBSET_PAIRS = 2
+
+def rule_pairs(rule):
+    """The (kind, attribute, value) pairs of a rule"""
+    return frozenset((kind, attr, value) for kind in KINDS for attr, value in rule[kind].items())
+
+def duplicate_groups(rules):
+    """Lists of the indices of equal rules, for every rule appearing more than once"""
+    groups = {}
+    for i, rule in enumerate(rules):
+        groups.setdefault(rule_key(rule), []).append(i)
+    return [indices for indices in groups.values() if len(indices) > 1]
+
+def find_subsumed(rules):
+    """
+    Map the index of every rule made redundant by a strictly more general rule with the
+    same op (one whose pairs are a proper subset of its pairs) to the index of that rule.
+    Every rule is indexed under its MAX_SUBSET_PAIRS rarest pairs. A more general rule
+    holds only pairs of the rule, so it is found under one of the small subsets of them,
+    and only the few rules indexed there are compared in full.
+    """
+    pairs = [rule_pairs(rule) for rule in rules]
+    frequency = {}
+    for i, rule in enumerate(rules):
+        for pair in pairs[i]:
+            frequency[(rule["op"], pair)] = frequency.get((rule["op"], pair), 0) + 1
+    index = {}
+    for i, rule in enumerate(rules):
+        if len(pairs[i]) != 0:
+            rarest = sorted(pairs[i], key=lambda pair: (frequency[(rule["op"], pair)], pair))
+            index.setdefault((rule["op"], frozenset(rarest[:MAX_SUBSET_PAIRS])), []).append(i)
+    # the smallest rules first, as only a rule with fewer pairs can be more general
+    for indices in index.values():
+        indices.sort(key=lambda j: len(pairs[j]))
+    smallest = {}
+    for i, rule in enumerate(rules):
+        smallest[rule["op"]] = min(smallest.get(rule["op"], len(pairs[i])), len(pairs[i]))
+
+    def more_general(i, op):
+        candidates = sorted(pairs[i])
+        for size in range(1, min(len(candidates), MAX_SUBSET_PAIRS) + 1):
+            for subset in combinations(candidates, size):
+                for j in index.get((op, frozenset(subset)), []):
+                    if len(pairs[j]) >= len(pairs[i]):
+                        break
+                    if pairs[j] <= pairs[i]:
+                        return j
+        return None
+
+    subsumed = {}
+    for i, rule in enumerate(rules):
+        if len(pairs[i]) <= smallest[rule["op"]]:
+            continue
+        j = more_general(i, rule["op"])
+        if j is not None:
+            subsumed[i] = j
+    return subsumed
+
+def minimize_rules(rules):
+    """
+    Drop duplicate rules and rules subsumed by a more general rule with the same op.
+    Grants nothing less than the original policy. The remaining rules keep their order
+    """
+    subsumed = find_subsumed(rules)
+    seen = set()
+    kept = []
+    for i, rule in enumerate(rules):
+        key = rule_key(rule)
+        if i in subsumed or key in seen:
+            continue
+        seen.add(key)
+        kept.append(rule)
+    return kept
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+def order_by_selectivity(rules, users, objects):
+    """
+    Sort the rules by the number of (user, object) pairs they match, the least selective
+    first, so that allowed accesses hit a matching rule early. users and objects are
+    iterables of avps dicts. The sort is stable
+    """
+    users = AttrBitsets(list(users))
+    # weight every distinct combination of object attributes by its number of objects
+    weights = {}
+    for avps in objects:
+        signature = frozenset(avps.items())
+        weights[signature] = weights.get(signature, 0) + 1
+    signatures = list(weights.keys())
+    objects = AttrBitsets([dict(signature) for signature in signatures])
+    coverage = []
+    for rule in rules:
+        user_count = popcount(users.satisfying(rule["user"]))
+        obj_count = 0
+        if user_count != 0:
+            obj_count = sum(weights[signatures[i]] for i in bit_indices(objects.satisfying(rule["obj"])))
+        coverage.append(user_count * obj_count)
+    order = sorted(range(len(rules)), key=lambda i: -coverage[i])
+    return [rules[i] for i in order]
@@ -0,0 +1,154 @@
+# ABAC directory attribute inheritance
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Attributes assigned to a directory are inherited by the directory and everything below
+it, existing or created later. Deeper directories override the attributes of their
+parents, and the attributes assigned to an object override the inherited ones.
+The kernel only knows about objects, so the inherited attributes are expanded into one
+entry per path when the object attributes are loaded.
+"""
+import os
+import stat
+import time
+import threading
+
+# listings of directories changed less than this many seconds before they were listed are
+# taken again on their next use, as changes within the timestamp granularity of the
+# filesystem can leave the mtime of a directory unchanged
+RACY_WINDOW = 2
+
+class TreeCache:
+    """
+    Listings of the directories below the directories with attributes, so that loading
+    the object attributes doesn't walk the whole trees every time. A listing is reused
+    while the mtime of its directory, which changes with every entry created, removed or
+    renamed in it, is unchanged. This holds across processes, so the server and the
+    watcher both see the files created since their last load. The watcher also
+    invalidates the paths of its events.
+    """
+
+    def __init__(self):
+        # {directory: (signature or None to list it again, sorted [(name, is_dir)])}
+        self.listings = {}
+        self.lock = threading.Lock()
+        # directories invalidated since their last listing
+        self.stale = set()
+
+    def invalidate(self, path):
+        """List path, and the directory holding it, again on their next use"""
+        with self.lock:
+            self.stale.add(path)
+            self.stale.add(os.path.dirname(path))
+
+    def listing(self, path):
+        """[(name, is_dir)] of the directory path, or None if it is not a directory"""
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode):
+            return None
+        signature = (st.st_ino, st.st_mtime_ns)
+        with self.lock:
+            stale = path in self.stale
+            self.stale.discard(path)
+        cached = self.listings.get(path)
+        if not stale and cached is not None and cached[0] == signature:
+            return cached[1]
+        listed_at = time.time()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted((e.name, e.is_dir(follow_symlinks=False)) for e in it)
+        except OSError:
+            return None
+        if listed_at - st.st_mtime < RACY_WINDOW:
+            signature = None
+        self.listings[path] = (signature, entries)
+        return entries
+
+    def walk(self, tops):
+        """
+        Yields (directory, [(name, is_dir)]) for every directory below each of tops, parents
+        first. Symlinks are not followed. Listings of directories no longer below tops are dropped
+        """
+        seen = set()
+        for top in tops:
+            stack = [top]
+            while len(stack) != 0:
+                path = stack.pop()
+                entries = self.listing(path)
+                if entries is None:
+                    continue
+                seen.add(path)
+                yield path, entries
+                for name, is_dir in entries:
+                    if is_dir:
+                        stack.append(os.path.join(path, name))
+        for path in list(self.listings):
+            if path not in seen:
+                del self.listings[path]
+
+# listings of the trees below the directories with attributes, shared by the loads of this process
+trees = TreeCache()
+
+def inherited_avps(path, dirs):
+    """Attributes path inherits from the directories in dirs, including path itself"""
+    ancestors = []
+    p = path
+    while True:
+        if p in dirs:
+            ancestors.append(p)
+        parent = os.path.dirname(p)
+        if parent == p:
+            break
+        p = parent
+    avps = {}
+    for d in reversed(ancestors):
+        avps.update(dirs[d])
+    return avps
+
+def top_dirs(dirs):
+    """The directories of dirs that are not below another directory of dirs"""
+    tops = []
+    for path in sorted(dirs):
+        if len(tops) == 0 or not path.startswith(tops[-1].rstrip("/") + "/"):
+            tops.append(path)
+    return tops
+
+def expand_dir_attrs(objects, dirs):
+    """
+    Yields the (path, avps) objects with the attributes they inherit from dirs, plus an
+    entry for every path below a directory of dirs, found from the listings of trees
+    """
+    if len(dirs) == 0:
+        yield from objects
+        return
+    objects = dict(objects)
+    tops = top_dirs(dirs)
+    # attributes inherited by the directories still to be visited
+    inherited = {top: inherited_avps(top, dirs) for top in tops}
+    # the paths without attributes of their own share the dict of the inherited ones
+    for root, entries in trees.walk(tops):
+        avps = inherited.pop(root)
+        own = objects.pop(root, None)
+        yield root, avps if own is None else dict(avps, **own)
+        prefix = root.rstrip("/") + "/"
+        for name, is_dir in entries:
+            child = prefix + name
+            child_avps = avps if child not in dirs else dict(avps, **dirs[child])
+            if is_dir:
+                inherited[child] = child_avps
+                continue
+            # files, and symlinks, which are not walked into
+            own = objects.pop(child, None)
+            yield child, child_avps if own is None else dict(child_avps, **own)
+    yield from objects.items()
+
+def effective_obj(store, path):
+    """Attributes of the object at path, including the inherited ones"""
+    return dict(inherited_avps(path, store.get_dirs()), **store.get_obj(path))
+
+def effective_objs(store):
+    """(path, avps) of every object of the store, including those inheriting attributes"""
+    return expand_dir_attrs(store.iter_objs(), store.get_dirs())
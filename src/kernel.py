@@ -0,0 +1,346 @@
+# ABAC kernel payload writer
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Pushes rendered attribute and policy payloads into the ABAC security file system.
+The last payload pushed to every kernel file is remembered so that subsequent
+pushes only send the entries that were added, changed or removed.
+Payloads are rendered into a spool, which moves to a temporary file once it grows
+past KERN_SPOOL_MAX_SIZE, and only written to the kernel once complete. They are
+written in fixed size chunks, so the rendered payload is never held in memory as a whole.
+A fingerprint of the payload loaded into each kernel file is kept in
+CONFIG_ROOT, so that pushing an unchanged payload is a no-op.
+"""
+import os
+import json
+import time
+import hashlib
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from .config import ABAC_MOUNT, CONFIG_ROOT, CONFIG_FINGERPRINT_FILE, CONFIG_FINGERPRINT_LOCK_FILE, BOOT_ID_FILE
+from .config import KERN_DELTA_SUFFIX, KERN_WRITE_CHUNK_SIZE, KERN_SPOOL_MAX_SIZE, EMPTY_PAYLOAD
+from .metrics import registry, SIZE_BUCKETS
+
+class FileSink:
+    """Writes payloads into the files exposed by the ABAC LSM at ABAC_MOUNT"""
+
+    def exists(self, kernel_file):
+        return Path(ABAC_MOUNT + kernel_file).is_file()
+
+    def supports_delta(self, kernel_file):
+        return Path(ABAC_MOUNT + kernel_file + KERN_DELTA_SUFFIX).is_file()
+
+    def open(self, kernel_file):
+        # unbuffered, so that every chunk reaches the kernel as a single write
+        return open(ABAC_MOUNT + kernel_file, 'wb', buffering=0)
+
+class RecordingSink:
+    """
+    Records every payload instead of writing it to the kernel. Used to measure
+    how many bytes each load sends to the kernel without an ABAC enabled kernel.
+    """
+
+    def __init__(self, delta=True, keep_data=True):
+        self.delta = delta
+        self.keep_data = keep_data
+        self.writes = []
+        self.bytes_written = {}
+
+    def exists(self, kernel_file):
+        return True
+
+    def supports_delta(self, kernel_file):
+        return self.delta
+
+    def open(self, kernel_file):
+        return _Recorder(self, kernel_file)
+
+    def total_bytes(self):
+        return sum(self.bytes_written.values())
+
+class _Recorder:
+    def __init__(self, sink, kernel_file):
+        self.sink = sink
+        self.kernel_file = kernel_file
+
+    def write(self, chunk):
+        if self.sink.keep_data:
+            self.sink.writes.append((self.kernel_file, bytes(chunk).decode()))
+        self.sink.bytes_written[self.kernel_file] = self.sink.bytes_written.get(self.kernel_file, 0) + len(chunk)
+        return len(chunk)
+
+    def close(self):
+        pass
+
+def write_all(f, data, kernel_file):
+    """Write all of data to f, which may accept only part of it per write"""
+    view = memoryview(data)
+    while len(view) > 0:
+        n = f.write(view)
+        if not n:
+            raise OSError(f"Short write to {ABAC_MOUNT + kernel_file}: {len(view)} bytes not written")
+        view = view[n:]
+
+class ChunkedWriter:
+    """
+    Buffers lines into chunks of chunk_size bytes, spooled until close() writes them
+    to a kernel file. Nothing reaches the kernel if the writer is aborted instead.
+    If lazy is set, the kernel file is only opened if there is something to write.
+    If hash is given, it is updated with every spooled chunk.
+    """
+
+    def __init__(self, kernel_file, chunk_size=KERN_WRITE_CHUNK_SIZE, lazy=False, hash=None):
+        self.kernel_file = kernel_file
+        self.chunk_size = chunk_size
+        self.lazy = lazy
+        self.hash = hash
+        self.buf = []
+        self.buf_size = 0
+        self.spool = tempfile.SpooledTemporaryFile(max_size=KERN_SPOOL_MAX_SIZE)
+        # size of every spooled chunk
+        self.chunks = []
+
+    def write(self, line):
+        self.write_bytes(line.encode())
+
+    def write_bytes(self, data):
+        size = len(data)
+        if self.buf_size + size > self.chunk_size:
+            self.flush()
+        self.buf.append(data)
+        self.buf_size += size
+
+    def flush(self):
+        if self.buf_size == 0:
+            return
+        chunk = b"".join(self.buf)
+        if self.hash is not None:
+            self.hash.update(chunk)
+        self.spool.write(chunk)
+        self.chunks.append(self.buf_size)
+        self.buf = []
+        self.buf_size = 0
+
+    def close(self):
+        """Write the spooled chunks to the kernel file. Returns the number of bytes written"""
+        self.flush()
+        written = 0
+        try:
+            if self.lazy and len(self.chunks) == 0:
+                return written
+            self.spool.seek(0)
+            f = sink.open(self.kernel_file)
+            try:
+                if len(self.chunks) == 0:
+                    # an empty payload still reaches the kernel, and clears the kernel file
+                    write_all(f, EMPTY_PAYLOAD, self.kernel_file)
+                    written += len(EMPTY_PAYLOAD)
+                for size in self.chunks:
+                    write_all(f, self.spool.read(size), self.kernel_file)
+                    written += size
+            finally:
+                f.close()
+            return written
+        finally:
+            self.spool.close()
+
+    def abort(self):
+        """Drop the spooled chunks without writing anything to the kernel"""
+        self.buf = []
+        self.chunks = []
+        self.spool.close()
+
+def get_boot_id():
+    try:
+        with open(BOOT_ID_FILE) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+class FingerprintStore:
+    """
+    Fingerprints of the payloads loaded into each kernel file and the number of reloads
+    skipped because of them. Kept in a json file at path so that all abac processes share
+    them, or in memory if path is None. Fingerprints from a previous boot are ignored,
+    as the kernel files are empty after a reboot.
+    Pushes hold locked(), so that the fingerprints always describe the last payload pushed.
+    """
+
+    def __init__(self, path=None, lock_path=None):
+        self.path = path
+        self.lock_path = lock_path
+        self.data = {"boot_id": get_boot_id(), "files": {}}
+        self.thread_lock = threading.RLock()
+
+    @contextmanager
+    def locked(self):
+        """Lock the fingerprints, and so the kernel files, across threads and processes"""
+        with self.thread_lock:
+            if self.lock_path is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self):
+        if self.path is None:
+            return self.data
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("boot_id") != get_boot_id():
+            # skip counters survive reboots, fingerprints don't
+            files = data.get("files", {})
+            data = {"boot_id": get_boot_id(), "files": {}}
+            for kernel_file, entry in files.items():
+                data["files"][kernel_file] = {"fingerprint": None, "skipped": entry.get("skipped", 0)}
+        return data
+
+    def write(self, data):
+        if self.path is None:
+            self.data = data
+            return
+        # write to a temporary file and rename, so readers never see a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, kernel_file):
+        return self.read()["files"].get(kernel_file, {}).get("fingerprint")
+
+    def set(self, kernel_file, fingerprint):
+        data = self.read()
+        entry = data["files"].setdefault(kernel_file, {"skipped": 0})
+        entry["fingerprint"] = fingerprint
+        self.write(data)
+
+    def record_skip(self, kernel_file):
+        """Increment and return the number of skipped reloads of kernel_file"""
+        data = self.read()
+        entry = data["files"].setdefault(kernel_file, {"fingerprint": None, "skipped": 0})
+        entry["skipped"] += 1
+        self.write(data)
+        return entry["skipped"]
+
+    def skipped(self):
+        """Number of skipped reloads of each kernel file"""
+        return {k: v.get("skipped", 0) for k, v in self.read()["files"].items()}
+
+# sink used for all kernel writes. Replaced with a RecordingSink for measurements
+sink = FileSink()
+
+# fingerprints of the payloads loaded into the kernel by the sink
+fingerprints = FingerprintStore(CONFIG_ROOT + CONFIG_FINGERPRINT_FILE, CONFIG_ROOT + CONFIG_FINGERPRINT_LOCK_FILE)
+
+# fingerprint and digests of the entries last pushed to each kernel file by this process.
+# {kernel_file: (fingerprint, {key: digest})}
+pushed = {}
+
+def set_sink(new_sink, new_fingerprints=None):
+    """
+    Replace the kernel sink. The pushed state and fingerprints belong to the old sink,
+    so they are replaced as well (with an in-memory store if none is given)
+    """
+    global sink, fingerprints
+    sink = new_sink
+    fingerprints = new_fingerprints if new_fingerprints is not None else FingerprintStore()
+    pushed.clear()
+
+def push(kernel_file, render, force=False, ordered=False):
+    """
+    Push the (key, line) entries returned by render() to kernel_file. The push is skipped
+    if the kernel already holds the same payload, unless force is set. Only the difference
+    from the last push is sent if the kernel supports delta updates and no other process
+    has written to kernel_file since, otherwise the full payload is written.
+    If ordered is set, the kernel depends on the order of the entries. A delta would append
+    the added entries after the others, so the full payload is always written.
+    Returns the number of bytes sent to the kernel or None if the push was skipped.
+    """
+    labels = (("file", kernel_file),)
+    # the fingerprint is compared, the payload pushed and the new fingerprint saved
+    # without another process pushing to the kernel in between
+    with fingerprints.locked():
+        current = fingerprints.get(kernel_file)
+        # the state is dropped until this push completes, so a failed push is
+        # followed by a full write
+        state = pushed.pop(kernel_file, None)
+        # the digests of the entries are only kept for the next delta push
+        delta = not ordered and sink.supports_delta(kernel_file)
+        old = None
+        if delta and not force and state is not None and state[0] == current:
+            old = state[1]
+        new = {} if delta else None
+        start = time.perf_counter()
+        # the payload is rendered once, fingerprinted while it is spooled
+        writer, new_fingerprint = spool_entries(kernel_file, render(), old, new)
+        if not force and current is not None and current == new_fingerprint:
+            writer.abort()
+            if delta:
+                pushed[kernel_file] = (current, new)
+            fingerprints.record_skip(kernel_file)
+            registry.inc("abac_kernel_pushes_total", labels + (("mode", "skipped"),))
+            return None
+
+        try:
+            written = writer.close()
+        except Exception:
+            # the kernel holds an unknown payload now
+            fingerprints.set(kernel_file, None)
+            raise
+        registry.observe("abac_kernel_write_seconds", time.perf_counter() - start, labels)
+        registry.observe("abac_kernel_write_bytes", written, labels, SIZE_BUCKETS)
+        registry.inc("abac_kernel_pushes_total", labels + (("mode", "full" if old is None else "delta"),))
+        fingerprints.set(kernel_file, new_fingerprint)
+        if delta:
+            pushed[kernel_file] = (new_fingerprint, new)
+        return written
+
+def spool_entries(kernel_file, entries, old, new):
+    """
+    Spool entries for kernel_file, as a delta from the old digests unless old is None.
+    If new is not None, the digests of the entries are collected in it. Returns the
+    writer, which sends the spool to the kernel on close(), and the sha256 fingerprint
+    of the full payload. A failing render leaves the kernel file untouched.
+    """
+    h = hashlib.sha256()
+    if old is None:
+        # the full payload is spooled, and hashed a chunk at a time
+        writer = ChunkedWriter(kernel_file, hash=h)
+    else:
+        writer = ChunkedWriter(kernel_file + KERN_DELTA_SUFFIX, lazy=True)
+    write = writer.write_bytes
+    try:
+        if old is None and new is None:
+            for key, line in entries:
+                write(line.encode())
+        elif old is None:
+            for key, line in entries:
+                data = line.encode()
+                new[key] = hashlib.blake2b(data, digest_size=16).digest()
+                write(data)
+        else:
+            for key, line in entries:
+                data = line.encode()
+                h.update(data)
+                d = hashlib.blake2b(data, digest_size=16).digest()
+                new[key] = d
+                if old.get(key) != d:
+                    write(b"+" + data)
+            for key in old:
+                if key not in new:
+                    writer.write(f"-{key}\n")
+        writer.flush()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer, h.hexdigest()
@@ -8,99 +8,57 @@ import json
 from pathlib import Path
 from .common import check_root
 from .config import *
+from . import kernel
+from .store import get_store
+from .engine import minimize_rules, order_by_selectivity
+from .inherit import expand_dir_attrs, effective_objs
 
-def check_files(config_path, kernel_path):
+def check_files(config_path, kernel_file):
     """
-    Checks if the files at config_path and kernel_paths are available.
+    Checks if the config file at config_path and the kernel file are available.
     """
     if not Path(config_path).is_file():
             sys.exit(f"ABAC config not initialized. {config_path} missing")
-    if not Path(kernel_path).is_file():
-        sys.exit(f"Kernel User attribute file {kernel_path} not found.")
+    check_kernel_file(kernel_file)
 
-def load_user_attr():
-    """parse user attributes json config and load them into the kernel"""
-    # check if the user attributes file is present
-    config_path = CONFIG_ROOT + CONFIG_USER_ATTRS_FILE  
-    kernel_path = ABAC_MOUNT + KERN_USER_ATTRS_FILE  
-    check_files(config_path, kernel_path)
+def check_kernel_file(kernel_file):
+    if not kernel.sink.exists(kernel_file):
+        sys.exit(f"Kernel attribute file {ABAC_MOUNT + kernel_file} not found.")
 
-    with open(config_path) as f:
-        users = json.load(f)["users"]
-    if len(users.keys()) == 0:
-        print("No user attributes found. Not writing anything...")
-        return
-    content = ""
-    for username, data in users.items():
+def report_push(kernel_file, written, msg):
+    if written is None:
+        skipped = kernel.fingerprints.skipped().get(kernel_file, 0)
+        print(f"{ABAC_MOUNT + kernel_file} is up to date. Reload skipped ({skipped} reloads skipped so far)")
+    else:
+        print(f"{msg} ({written} bytes written)")
+
+def render_user_attr(users):
+    """yields (key, line) kernel entries for the (username, data) users. Keyed by uid"""
+    for username, data in users:
         avps = []
         for name, value in data['avps'].items():
             avps.append(f"{name}={value}")
         if len(avps) == 0:
             continue
-        content += f"{data['uid']}:{','.join(avps)}\n"
-    with open(kernel_path, 'w') as f:
-        f.write(content)
-    print("User attributes loaded into the kernel")
-
-def load_obj_attr():
-    """parse user attributes json config and load them into the kernel"""
-    # check if the user attributes file is present
-    config_path = CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE
-    kernel_path = ABAC_MOUNT + KERN_OBJ_ATTRS_FILE 
-    check_files(config_path, kernel_path)
+        yield str(data['uid']), f"{data['uid']}:{','.join(avps)}\n"
 
-    # read object attributes, parse them and write data to kernel file
-    with open(config_path) as f:
-        objects = json.load(f)["objects"]
-    if len(objects.keys()) == 0:
-        print("No object attributes found. Not writing anything...")
-        return
-    content = ""
-    for path, avp_dict in objects.items():
+def render_obj_attr(objects):
+    """yields (key, line) kernel entries for the (path, avps) objects. Keyed by path"""
+    for path, avp_dict in objects:
         avps = []
         for name, value in avp_dict.items():
             avps.append(f"{name}={value}")
         if len(avps) == 0:
             continue
-        content += f"{path}:{','.join(avps)}\n"
-    with open(kernel_path, 'w') as f:
-        f.write(content)
-    print("Object attributes loaded into the kernel")
+        yield path, f"{path}:{','.join(avps)}\n"
 
-def load_env_attr():
-    """parse environment attributes json config and load them into the kernel"""
-    # check if the user attributes file is present
-    config_path = CONFIG_ROOT + CONFIG_ENV_ATTRS_FILE
-    kernel_path = ABAC_MOUNT + KERN_ENV_ATTRS_FILE 
-    check_files(config_path, kernel_path)
-
-    # read object attributes, parse them and write data to kernel file
-    with open(config_path) as f:
-        envs = json.load(f)["env"]
-    if len(envs.keys()) == 0:
-        print("No Environment attributes found. Not writing anything...")
-        return
-    content = ""
+def render_env_attr(envs):
+    """yields (key, line) kernel entries for the environment attributes. Keyed by name"""
     for env, value in envs.items():
-        content += f"{env}={value}\n"
-    with open(kernel_path, 'w') as f:
-        f.write(content)
-    print("Environment attributes loaded into the kernel")
-
+        yield env, f"{env}={value}\n"
 
-def load_policy():
-    """parse policy json and load the rules into the kernel"""
-    config_path = CONFIG_ROOT + CONFIG_POLICY_FILE
-    kernel_path = ABAC_MOUNT + KERN_POLICY_FILE
-    check_files(config_path, kernel_path)
-
-    # read object attributes, parse them and write data to kernel file
-    with open(CONFIG_ROOT + CONFIG_POLICY_FILE) as f:
-        rules = json.load(f)["rules"]
-    if len(rules) == 0:
-        print("No rules found. Not writing anything...")
-        return
-    content = ""
+def render_policy(rules):
+    """yields (key, line) kernel entries for the policy rules. Keyed by the rule itself"""
     for rule in rules:
         # user attrs
         avps = []
@@ -120,14 +78,92 @@ def load_policy():
             line += "*" + "|"
         else:
             line += ",".join(avps) + "|"
-        line += rule["op"] + "\n"
-        content += line
-    with open(ABAC_MOUNT + KERN_POLICY_FILE, 'w') as f:
-        f.write(content)
-    print("ABAC Policy loaded into kernel")
+        line += rule["op"]
+        yield line, line + "\n"
+
+def load_user_attr(force=False):
+    """read user attributes from the store and load them into the kernel"""
+    check_kernel_file(KERN_USER_ATTRS_FILE)
+
+    users = list(get_store().iter_users())
+    if len(users) == 0:
+        print("No user attributes found. Clearing the user attributes in the kernel")
+    written = kernel.push(KERN_USER_ATTRS_FILE, lambda: render_user_attr(users), force)
+    report_push(KERN_USER_ATTRS_FILE, written, "User attributes loaded into the kernel")
+    return written
+
+def load_obj_attr(force=False, objects=None):
+    """
+    read object attributes from the store and load them into the kernel.
+    A caller already holding all the (path, avps) objects can pass them instead.
+    Attributes inherited from directories are expanded into an entry per path
+    """
+    check_kernel_file(KERN_OBJ_ATTRS_FILE)
+
+    # read object attributes, parse them and write data to kernel file
+    if objects is None:
+        objects = get_store().iter_objs()
+    dirs = get_store().get_dirs()
+    # the objects are streamed from the store into the kernel, and counted on the way
+    rendered = 0
+    def render():
+        nonlocal rendered
+        for entry in render_obj_attr(expand_dir_attrs(objects, dirs)):
+            rendered += 1
+            yield entry
+    written = kernel.push(KERN_OBJ_ATTRS_FILE, render, force)
+    if rendered == 0:
+        print("No object attributes found. The object attributes in the kernel are cleared")
+    report_push(KERN_OBJ_ATTRS_FILE, written, "Object attributes loaded into the kernel")
+    return written
+
+def load_env_attr(force=False):
+    """parse environment attributes json config and load them into the kernel"""
+    # check if the environment attributes file is present
+    config_path = CONFIG_ROOT + CONFIG_ENV_ATTRS_FILE
+    check_files(config_path, KERN_ENV_ATTRS_FILE)
+
+    # read environment attributes, parse them and write data to kernel file
+    with open(config_path) as f:
+        envs = json.load(f)["env"]
+    if len(envs.keys()) == 0:
+        print("No Environment attributes found. Clearing the environment attributes in the kernel")
+    written = kernel.push(KERN_ENV_ATTRS_FILE, lambda: render_env_attr(envs), force)
+    report_push(KERN_ENV_ATTRS_FILE, written, "Environment attributes loaded into the kernel")
+    return written
+
+
+def minimize_policy(rules):
+    """rules without the redundant ones, ordered from the least to the most selective"""
+    store = get_store()
+    kept = minimize_rules(rules)
+    kept = order_by_selectivity(kept, (data["avps"] for _, data in store.iter_users()),
+            (avps for _, avps in effective_objs(store)))
+    print(f"Policy minimized: {len(rules) - len(kept)} of {len(rules)} rules removed")
+    return kept
+
+def load_policy(force=False, minimize=POLICY_MINIMIZE):
+    """
+    read the policy from the store and load the rules into the kernel.
+    With minimize, redundant rules are not loaded (see POLICY_MINIMIZE)
+    """
+    check_kernel_file(KERN_POLICY_FILE)
+
+    # read policy rules, parse them and write data to kernel file
+    rules = get_store().get_rules()
+    if len(rules) == 0:
+        print("No rules found. Clearing the policy in the kernel")
+    elif minimize:
+        rules = minimize_policy(rules)
+    # the minimized rules are ordered by selectivity, which a delta push wouldn't keep
+    written = kernel.push(KERN_POLICY_FILE, lambda: render_policy(rules), force, ordered=minimize)
+    report_push(KERN_POLICY_FILE, written, "ABAC Policy loaded into kernel")
+    return written
 
 @click.command()
-def load():
+@click.option('-f', '--force', default=False, is_flag=True, help='Reload everything, even if the kernel already holds the same attributes and policy.')
+@click.option('-m', '--minimize', default=POLICY_MINIMIZE, is_flag=True, help='Do not load duplicate rules and rules subsumed by a more general rule, and order the rules by selectivity.')
+def load(force, minimize):
     """Load user, object attributes and ABAC Policy into the Kernel"""
 
     check_root()
@@ -138,7 +174,7 @@ def load():
     if not p.is_dir():
         sys.exit(f"ABAC security file system is not mounted. Please check if the ABAC LSM is loaded")
 
-    load_policy()
-    load_user_attr()
-    load_obj_attr()
-    load_env_attr()
+    load_policy(force, minimize)
+    load_user_attr(force)
+    load_obj_attr(force)
+    load_env_attr(force)
@@ -15,6 +15,11 @@ from .avp import avp
 from .server import server
 from .watch import watch
 from .env_update import env_update
+from .migrate import migrate
+from .stats import stats
+from .check import check
+from .audit import audit
+from .reconcile import reconcile
 
 @click.group()
 def main():
@@ -30,3 +35,8 @@ main.add_command(policy)
 main.add_command(server)
 main.add_command(watch)
 main.add_command(env_update)
+main.add_command(migrate)
+main.add_command(stats)
+main.add_command(check)
+main.add_command(audit)
+main.add_command(reconcile)
@@ -0,0 +1,116 @@
+# ABAC metrics
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+In-process counters, gauges and histograms, rendered in the Prometheus text format.
+Labels are tuples of (name, value) pairs.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# payload size buckets in bytes
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        # bucket counts are cumulative in the Prometheus format
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), n=1):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + n
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges.setdefault(name, {})[labels] = value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if labels not in series:
+                series[labels] = Histogram(buckets)
+            series[labels].observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        """Observe the duration of the with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def snapshot(self):
+        """Plain dicts and lists, so that the metrics can be sent to clients"""
+        with self.lock:
+            return {
+                "counters": {name: [[[list(p) for p in l], v] for l, v in series.items()] for name, series in self.counters.items()},
+                "gauges": {name: [[[list(p) for p in l], v] for l, v in series.items()] for name, series in self.gauges.items()},
+                "histograms": {name: [[[list(p) for p in l], h.snapshot()] for l, h in series.items()] for name, series in self.histograms.items()},
+            }
+
+def escape_label_value(value):
+    """Escape a label value as the Prometheus text format requires"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels, extra=None):
+    labels = list(labels)
+    if extra is not None:
+        labels.append(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+def render_prometheus(snapshot):
+    """Render a registry snapshot in the Prometheus text exposition format"""
+    lines = []
+    for name, series in sorted(snapshot["counters"].items()):
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in series:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, series in sorted(snapshot["gauges"].items()):
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in series:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, series in sorted(snapshot["histograms"].items()):
+        lines.append(f"# TYPE {name} histogram")
+        for labels, h in series:
+            for bound, count in h["buckets"]:
+                lines.append(f"{name}_bucket{format_labels(labels, ('le', bound))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, ('le', '+Inf'))} {h['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {h['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+# metrics of this process
+registry = Registry()
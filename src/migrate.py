@@ -0,0 +1,67 @@
+# ABAC store migration
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+import os
+import sys
+import click
+from pathlib import Path
+from .config import CONFIG_ROOT, CONFIG_DB_FILE, CONFIG_USER_ATTRS_FILE, STORE_BACKEND
+from .common import check_root
+from .store import JSONStore, SQLiteStore
+
+db_path = CONFIG_ROOT + CONFIG_DB_FILE
+
+def copy_store(src, dst):
+    """Replace the users, objects, directory and attribute-value pairs and the policy of dst with those of src"""
+    dst.clear()
+    dst.set_avps(src.get_avps())
+    dst.set_rules(src.get_rules())
+    users = dict(src.iter_users())
+    dst.update_users(users)
+    objects = dict(src.iter_objs())
+    dst.update_objs(objects)
+    for path, avps in src.get_dirs().items():
+        dst.set_dir(path, avps)
+    return len(users), len(objects)
+
+@click.command()
+@click.option('-f', '--force', default=False, is_flag=True, help='Overwrite the existing destination store.')
+@click.option('--to', 'to', type=click.Choice(['sqlite', 'json']), default='sqlite', help="Backend to migrate to.")
+def migrate(to, force):
+    """\b
+    Migrate the ABAC attributes and policy between store backends. YOU MUST BE ROOT TO USE THIS COMMAND
+    sqlite  - Copy the json config files into an indexed SQLite database at /etc/abac/abac.db.
+              The json files are left untouched, but are no longer used.
+    json    - Copy the SQLite database back into the json config files and remove the database."""
+    check_root()
+
+    if not Path(CONFIG_ROOT + CONFIG_USER_ATTRS_FILE).is_file():
+        sys.exit("ABAC config not initialized. Please run 'abac init' and try again.")
+    if STORE_BACKEND != "auto":
+        print(f"Warning: the store backend is fixed to '{STORE_BACKEND}' in the ABAC configuration")
+
+    if to == "sqlite":
+        if Path(db_path).is_file():
+            if not force:
+                sys.exit(f"{db_path} already exists. Use --force to overwrite it")
+            os.remove(db_path)
+        # build the database under a temporary name, so that a failed migration is never picked up
+        tmp_path = db_path + ".tmp"
+        if Path(tmp_path).is_file():
+            os.remove(tmp_path)
+        dst = SQLiteStore(tmp_path)
+        users, objects = copy_store(JSONStore(), dst)
+        dst.conn.close()
+        os.replace(tmp_path, db_path)
+    else:
+        if not Path(db_path).is_file():
+            sys.exit(f"{db_path} not found. Nothing to migrate")
+        src = SQLiteStore(db_path)
+        dst = JSONStore()
+        users, objects = copy_store(src, dst)
+        # fold the copied objects into obj_attr.json right away
+        dst.compact()
+        src.conn.close()
+        os.remove(db_path)
+    print(f"Migrated {users} users and {objects} objects to the {to} store")
+    print("Restart the ABAC services for the change to take effect")
@@ -6,9 +6,41 @@ import sys
 import click
 from pathlib import Path
 from multiprocessing.connection import Client
-from .config import PORT, SHARED_DIR
+from .config import PORT, SERVER_SOCKET, SHARED_DIR, OBJ_BULK_BATCH_SIZE
+from .load import load_obj_attr
 
-address = ('localhost', PORT)
+# connect to the server over TCP instead of its unix socket. Set by the --tcp flag
+use_tcp = False
+# manage the attributes a directory passes on to everything below it. Set by the --dir flag
+dir_attrs = False
+
+def request(payload):
+    """Send payload to the attribute server and return its reply"""
+    if use_tcp:
+        # the server can't verify who is on the other end of a TCP connection and has to
+        # trust the uid sent with the request. Over the unix socket, the kernel tells it
+        payload["uid"] = os.geteuid()
+        conn = Client(('localhost', PORT))
+    else:
+        conn = Client(SERVER_SOCKET, family='AF_UNIX')
+    with conn:
+        conn.send(payload)
+        return conn.recv()
+
+def reload_obj_attr():
+    """
+    Reload the object attributes through the attribute server, so that the reload is
+    ordered with the server's own. Loads them directly if the server isn't running
+    """
+    try:
+        reply = request({"action": "RELOAD"})
+    except (ConnectionError, FileNotFoundError):
+        load_obj_attr()
+        return
+    if "error" in reply:
+        print(reply["error"])
+    else:
+        print("Object attributes reloaded by the attribute server")
 
 def input_obj_avps(avps):
     while True:
@@ -30,19 +62,14 @@ def input_obj_avps(avps):
 
 def get_available_avps():
     payload = {"action": "AVAILABLE"}
-    with Client(address) as conn:
-        conn.send(payload)
-        msg = conn.recv()
+    msg = request(payload)
     if "error" in msg:
         sys.exit(f"The following error occured\n{msg['error']}")
     return msg["avps"]
 
 def get_assigned_attr(object_path):
-    uid = os.geteuid()
-    payload = {"action": "LIST", "uid": uid, "object": object_path}
-    with Client(address) as conn:
-        conn.send(payload)
-        msg = conn.recv()
+    payload = {"action": "LIST", "object": object_path, "dir": dir_attrs}
+    msg = request(payload)
     if "error" in msg:
         sys.exit(f"The following error occured\n{msg['error']}")
     avps = msg["avps"]
@@ -62,6 +89,17 @@ def list_attr(object_path):
     avps = get_assigned_attr(object_path)
     print_avps(avps)
 
+def list_attr_recursive(object_path):
+    payload = {"action": "LIST", "object": object_path, "recursive": True}
+    msg = request(payload)
+    if "error" in msg:
+        sys.exit(f"The following error occured\n{msg['error']}")
+    if len(msg["objects"]) == 0:
+        print("No attributes assigned to objects in this directory.")
+        return
+    for path, avps in msg["objects"].items():
+        print(f"{path} : {', '.join(f'{name} = {value}' for name, value in avps.items())}")
+
 def add_attr(object_path):
     available_avps = get_available_avps()
     if len(available_avps.keys()) == 0:
@@ -83,10 +121,8 @@ def add_attr(object_path):
     if new_value not in valid_values:
         sys.exit("Invalid attribute value.")
     assigned_avps[new_name] = new_value
-    payload = {"action": "UPDATE", "object": object_path,"uid": os.geteuid(), "avps": assigned_avps}
-    with Client(address) as conn:
-        conn.send(payload)
-        msg = conn.recv()
+    payload = {"action": "UPDATE", "object": object_path, "avps": assigned_avps, "dir": dir_attrs}
+    msg = request(payload)
     if "error" in msg:
         sys.exit(f"The following error occured\n{msg['error']}")
     if "status" in msg and msg["status"] == "OK":
@@ -104,10 +140,8 @@ def change_attr(object_path):
     if val not in values:
         sys.exit("Invalid value")
     assigned_avps[name] = val
-    payload = {"action": "UPDATE", "object": object_path,"uid": os.geteuid(), "avps": assigned_avps}
-    with Client(address) as conn:
-        conn.send(payload)
-        msg = conn.recv()
+    payload = {"action": "UPDATE", "object": object_path, "avps": assigned_avps, "dir": dir_attrs}
+    msg = request(payload)
     if "error" in msg:
         sys.exit(f"The following error occured\n{msg['error']}")
     if "status" in msg and msg["status"] == "OK":
@@ -121,35 +155,125 @@ def delete_attr(object_path):
     if name not in assigned_avps.keys():
         sys.exit("Invalid attribute name.")
     del assigned_avps[name]
-    payload = {"action": "UPDATE", "object": object_path,"uid": os.geteuid(), "avps": assigned_avps}
-    with Client(address) as conn:
-        conn.send(payload)
-        msg = conn.recv()
+    payload = {"action": "UPDATE", "object": object_path, "avps": assigned_avps, "dir": dir_attrs}
+    msg = request(payload)
     if "error" in msg:
         sys.exit(f"The following error occured\n{msg['error']}")
     if "status" in msg and msg["status"] == "OK":
         print("Success")
 
 
+def in_shared_dir(object_path):
+    secured_dir_path = str(Path(SHARED_DIR))
+    return object_path[:len(secured_dir_path)] == secured_dir_path
+
+def walk_paths(object_path):
+    """yields object_path and every file and directory below it"""
+    yield object_path
+    for root, dirs, files in os.walk(object_path):
+        for name in dirs + files:
+            yield os.path.join(root, name)
+
+def read_paths(from_file):
+    """yields the resolved paths listed in from_file, one per line. '-' reads stdin"""
+    f = sys.stdin if from_file == "-" else open(from_file)
+    try:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            path = str(Path(line).resolve())
+            if not in_shared_dir(path):
+                print(f"Skipping {line}. Only files in the {SHARED_DIR} are covered by ABAC rules")
+                continue
+            yield path
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def send_bulk_update(paths, avps):
+    payload = {"action": "BULK_UPDATE", "updates": {p: avps for p in paths}, "merge": True}
+    msg = request(payload)
+    if "error" in msg:
+        sys.exit(f"The following error occured\n{msg['error']}")
+    return msg["count"]
+
+def bulk_add_attr(paths):
+    """Assign one attribute-value pair to all paths, sent to the server in batches"""
+    available_avps = get_available_avps()
+    if len(available_avps.keys()) == 0:
+        print("No attributes avialable to assign to these objects")
+        sys.exit()
+    names = list(available_avps.keys())
+    new_name = input(f"Select attribute from - {', '.join(names)}: ")
+    if new_name not in names:
+        sys.exit("Invalid attribute name.")
+    valid_values = available_avps[new_name]
+    new_value = input(f"Select value - {new_name} from [{', '.join(valid_values)}]: ")
+    if new_value not in valid_values:
+        sys.exit("Invalid attribute value.")
+
+    total = 0
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) == OBJ_BULK_BATCH_SIZE:
+            total += send_bulk_update(batch, {new_name: new_value})
+            print(f"{total} objects updated")
+            batch = []
+    if len(batch) > 0:
+        total += send_bulk_update(batch, {new_name: new_value})
+    print(f"Success. {total} objects updated")
+
 @click.command()
+@click.option('-r', '--recursive', default=False, is_flag=True, help="add: assign the attribute to every file and directory below object_path. list: list the attributes of every object below object_path.")
+@click.option('--from-file', 'from_file', type=str, help="add: assign the attribute to the paths listed in this file (one per line, '-' for stdin).")
+@click.option('-d', '--dir', 'dir_', default=False, is_flag=True, help="list, add, change, delete: manage the attributes inherited by everything below the directory object_path, instead of its own.")
+@click.option('--tcp', default=False, is_flag=True, help="Connect to the attribute server over TCP. The server must be started with --tcp.")
 @click.argument('action', type=click.Choice(['list', 'add', 'delete', 'change']))
-@click.argument('object_path', type=str)
-def obj(action, object_path):
+@click.argument('object_path', type=str, required=False)
+def obj(action, object_path, recursive, from_file, dir_, tcp):
     """\b
     Set ABAC object attributes. Available actions
-    list    - List the attributes of an object
+    list    - List the attributes of an object, or with -r of every object in a directory
     add     - Add attributes for an object
     change  - Change an object's attribute value
     delete  - Delete an existing object's attributes
+    With -d, list, add, change and delete manage the attributes of a directory, which
+    everything below it inherits, existing or created later. The attributes of an
+    object override the inherited ones. Only root, or a user owning the directory and
+    everything already in it, may change them. Files other users create in the directory
+    later inherit them too.
     """
+    global use_tcp, dir_attrs
+    use_tcp = tcp
+    dir_attrs = dir_
 
+    if from_file:
+        if action != "add":
+            sys.exit("--from-file is only supported by the 'add' action")
+        try:
+            bulk_add_attr(read_paths(from_file))
+        except (ConnectionError, FileNotFoundError):
+            sys.exit("Failed to connect to the ABAC object attribute service. Please make sure that it is running.")
+        return
+
+    if object_path is None:
+        sys.exit("Missing argument 'OBJECT_PATH'")
     object_path = str(Path(object_path).resolve())
-    secured_dir_path = str(Path(SHARED_DIR))
-    if object_path[:len(secured_dir_path)] != secured_dir_path:
+    if not in_shared_dir(object_path):
         sys.exit(f"Only files in the {SHARED_DIR} are covered by ABAC rules")
+    if dir_ and (recursive or not os.path.isdir(object_path)):
+        sys.exit("--dir requires a directory and can't be combined with -r")
+    if recursive and action not in ("add", "list"):
+        sys.exit("-r is only supported by the 'add' and 'list' actions")
 
     try:
-        if action == "list":
+        if recursive and action == "list":
+            list_attr_recursive(object_path)
+        elif recursive:
+            bulk_add_attr(walk_paths(object_path))
+        elif action == "list":
             list_attr(object_path)
         elif action == "add":
             add_attr(object_path)
@@ -157,7 +281,7 @@ def obj(action, object_path):
             delete_attr(object_path)
         elif action == "change":
             change_attr(object_path)
-    except ConnectionError:
+    except (ConnectionError, FileNotFoundError):
         sys.exit("Failed to connect to the ABAC object attribute service. Please make sure that it is running.")
     except Exception as e:
         print("The following occured\n", e)
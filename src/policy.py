@@ -7,8 +7,11 @@ import json
 import click
 from pathlib import Path
 from .config import CONFIG_ROOT, CONFIG_POLICY_FILE, CONFIG_AVP_FILE
-from .common import check_root
+from .common import check_root, get_env_attrs, read_records, parse_csv_avps
 from .load import load_policy
+from .store import get_store
+from .inherit import effective_objs
+from .engine import KINDS, rule_key, AttrBitsets, duplicate_groups, find_subsumed, access_delta
 
 policy_path = CONFIG_ROOT + CONFIG_POLICY_FILE
 avp_path = CONFIG_ROOT + CONFIG_AVP_FILE
@@ -48,23 +51,46 @@ def print_rule(rule):
 
 
 def list_rules():
-    with open(policy_path, 'r') as f:
-        rules = json.load(f)["rules"]
+    rules = get_store().get_rules()
     if len(rules) == 0:
         print("No rules created yet")
         return
     for i, rule in enumerate(rules):
         print(f"[{i}] {print_rule(rule)}")
 
-def add_rule():
-    with open(policy_path, 'r') as f:
-        rules = json.load(f)["rules"]
-    with open(avp_path, 'r') as f:
-        available_avps = json.load(f)
-        if len(available_avps["user"].keys()) == 0:
-            sys.exit("User attribute-value pairs are not yet created. Please create atleast one avp before adding rules.")
-        if len(available_avps["obj"].keys()) == 0:
-            sys.exit("Object attribute-value pairs are not yet created. Please create atleast one avp before adding rules.")
+def print_access_delta(old_rules, new_rules):
+    """Print the accesses granted (+) and revoked (-) by replacing old_rules with new_rules, under the current environment"""
+    store = get_store()
+    delta = access_delta(old_rules, new_rules, list(store.iter_users()), effective_objs(store), get_env_attrs())
+    granted = revoked = 0
+    for grant, username, path, op in delta:
+        print(f"{'+' if grant else '-'} {username} {op} {path}")
+        if grant:
+            granted += 1
+        else:
+            revoked += 1
+    print(f"{granted} accesses granted, {revoked} accesses revoked")
+
+def read_policy_file(path):
+    try:
+        with open(path) as f:
+            return json.load(f)["rules"]
+    except (OSError, ValueError, KeyError) as e:
+        sys.exit(f"Invalid policy file {path}: {e}")
+
+def diff_policies(files):
+    if len(files) != 2:
+        sys.exit("Usage: abac policy diff OLD_POLICY NEW_POLICY")
+    print_access_delta(read_policy_file(files[0]), read_policy_file(files[1]))
+
+def add_rule(dry_run=False):
+    store = get_store()
+    rules = store.get_rules()
+    available_avps = store.get_avps()
+    if len(available_avps["user"].keys()) == 0:
+        sys.exit("User attribute-value pairs are not yet created. Please create atleast one avp before adding rules.")
+    if len(available_avps["obj"].keys()) == 0:
+        sys.exit("Object attribute-value pairs are not yet created. Please create atleast one avp before adding rules.")
 
     print("Follow the prompt to add new rule")
     user_avps = input_avps("Input USER attribute-value pairs. Press ENTER to move to next step", available_avps["user"])
@@ -80,18 +106,87 @@ def add_rule():
     new_rule = {'user': user_avps, 'obj': obj_avps, 'env': env_avps, 'op': "MODIFY" if op == "M" else "READ"}
     if new_rule in rules:
         sys.exit(f"{print_rule(new_rule)}\nRule already exists")
+    if dry_run:
+        print(f"{print_rule(new_rule)}\nImpact of adding the above rule (not added):")
+        print_access_delta(rules, rules + [new_rule])
+        return
     confirm = input(f"{print_rule(new_rule)}\nAre you sure you want to add the above rule to the policy? [Y/N] ")
     if confirm.lower() != "y":
         sys.exit("Aborted")
-    rules.append(new_rule)
-    with open(policy_path, 'w') as f:
-        json.dump({"rules": rules}, f)
+    store.add_rules([new_rule])
     print("Rule added succesfully")
     load_policy()
 
+def parse_import_record(record, csv_format):
+    """Build a rule from an imported record. Raises ValueError if the record is malformed"""
+    rule = {}
+    for kind in KINDS:
+        avps = record.get(kind, {})
+        if csv_format:
+            avps = parse_csv_avps(avps or "")
+        if not isinstance(avps, dict) or not all(isinstance(v, str) for v in avps.values()):
+            raise ValueError(f"'{kind}' must map attribute names to values")
+        rule[kind] = avps
+    op = str(record.get("op", "")).strip().upper()
+    op = {"R": "READ", "M": "MODIFY"}.get(op, op)
+    if op not in ("READ", "MODIFY"):
+        raise ValueError(f"invalid operation '{record.get('op', '')}'")
+    rule["op"] = op
+    return rule
+
+def validate_rule(rule, value_sets):
+    """Reason why the rule is invalid, or None"""
+    if len(rule["user"]) == 0:
+        return "at least one user attribute-value pair is required"
+    if len(rule["obj"]) == 0:
+        return "at least one object attribute-value pair is required"
+    for kind in KINDS:
+        for attr, value in rule[kind].items():
+            if attr not in value_sets[kind]:
+                return f"unknown {kind} attribute {attr}"
+            if value not in value_sets[kind][attr]:
+                return f"invalid value {value} for {kind} attribute {attr}"
+    return None
+
+def import_rules(path, skip_invalid):
+    store = get_store()
+    rules = store.get_rules()
+    value_sets = {kind: {attr: set(values) for attr, values in avps.items()} for kind, avps in store.get_avps().items()}
+    seen = {rule_key(rule) for rule in rules}
+    csv_format = path.lower().endswith(".csv")
+
+    new_rules = []
+    invalid = duplicates = 0
+    for line_number, record, error in read_records(path):
+        if record is not None:
+            try:
+                rule = parse_import_record(record, csv_format)
+                error = validate_rule(rule, value_sets)
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            print(f"{path}:{line_number}: {error}")
+            invalid += 1
+            continue
+        key = rule_key(rule)
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+        new_rules.append(rule)
+
+    if invalid != 0 and not skip_invalid:
+        sys.exit(f"{invalid} invalid rules. Nothing imported. Fix them or use --skip-invalid to import the valid rules")
+    if len(new_rules) == 0:
+        print(f"No new rules to import ({duplicates} duplicates, {invalid} invalid)")
+        return
+    store.add_rules(new_rules)
+    print(f"{len(new_rules)} rules imported ({duplicates} duplicates, {invalid} invalid skipped)")
+    load_policy()
+
 def delete_rule():
-    with open(policy_path, 'r') as f:
-        rules = json.load(f)["rules"]
+    store = get_store()
+    rules = store.get_rules()
     if len(rules) == 0:
         print("No rules created yet")
         return
@@ -102,32 +197,97 @@ def delete_rule():
     if not index.isnumeric() or int(index) < 0 or int(index) >= len(rules):
         sys.exit("Invalid input")
     index = int(index)
-    confirm = input(f"{print_rule(new_rule)}\nAre you sure you want to delete the above rule from the policy? [Y/N] ")
+    confirm = input(f"{print_rule(rules[index])}\nAre you sure you want to delete the above rule from the policy? [Y/N] ")
     if confirm.lower() != "y":
         sys.exit("Aborted")
     del(rules[index])
-    with open(policy_path, 'w') as f:
-        json.dump({"rules": rules}, f)
+    store.set_rules(rules)
     print("Rule deleted successfully")
     load_policy()
 
+def invalid_pairs(rule, available_avps):
+    """attr=value pairs of the rule whose value is not defined in avp.json"""
+    invalid = []
+    for kind in KINDS:
+        for attr, value in rule[kind].items():
+            if value not in available_avps[kind].get(attr, []):
+                invalid.append(f"{kind} {attr}={value}")
+    return invalid
+
+def analyze_rules():
+    store = get_store()
+    rules = store.get_rules()
+    if len(rules) == 0:
+        print("No rules created yet")
+        return
+    available_avps = store.get_avps()
+    users = AttrBitsets([data["avps"] for _, data in store.iter_users()])
+    # objects with the same attributes are the same for the analysis
+    signatures = {frozenset(avps.items()) for _, avps in effective_objs(store)}
+    objects = AttrBitsets([dict(signature) for signature in signatures])
+
+    findings = 0
+    for indices in duplicate_groups(rules):
+        print(f"Duplicate: rules {', '.join(f'[{i}]' for i in indices)} {print_rule(rules[indices[0]])}")
+        findings += len(indices) - 1
+    for i, j in sorted(find_subsumed(rules).items()):
+        print(f"Subsumed: [{i}] {print_rule(rules[i])}\n    by the more general rule [{j}] {print_rule(rules[j])}")
+        findings += 1
+    for i, rule in enumerate(rules):
+        invalid = invalid_pairs(rule, available_avps)
+        if len(invalid) != 0:
+            print(f"Invalid: [{i}] {print_rule(rule)}\n    undefined values {', '.join(invalid)}")
+            findings += 1
+            continue
+        unreachable = []
+        if users.satisfying(rule["user"]) == 0:
+            unreachable.append("no user holds all its user attributes")
+        if objects.satisfying(rule["obj"]) == 0:
+            unreachable.append("no object holds all its object attributes")
+        if len(unreachable) != 0:
+            print(f"Unreachable: [{i}] {print_rule(rule)}\n    {' and '.join(unreachable)}")
+            findings += 1
+    print(f"{len(rules)} rules analyzed, {findings} findings")
+
 @click.command()
 @click.option('-f', '--force', default=False, is_flag=True, help='Force initialize policy file. Overwrites existing rules.')
-@click.argument('action', type=click.Choice(['add', 'list', 'delete']))
-def policy(action, force):
+@click.option('-n', '--dry-run', 'dry_run', default=False, is_flag=True, help='add: show the accesses the new rule would grant, without adding it.')
+@click.option('--skip-invalid', 'skip_invalid', default=False, is_flag=True, help='import: import the valid rules even if some are invalid.')
+@click.argument('action', type=click.Choice(['add', 'list', 'delete', 'analyze', 'diff', 'import']))
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def policy(action, force, dry_run, skip_invalid, files):
     """\b
     Manage ABAC Policy. YOU MUST BE ROOT TO USE THIS COMMAND
     The following actions are supported.
     add     - Add a new rule to the policy 
     list    - List existing rules in the policy
-    delete  - Delete a rule from the policy"""
+    delete  - Delete a rule from the policy
+    analyze - Report duplicate rules, rules subsumed by a more general rule with the
+              same operation, and rules with undefined values or that no current
+              user or object satisfies
+    diff    - Show the accesses granted and revoked by replacing the policy file OLD
+              with NEW under the current attributes: abac policy diff OLD NEW
+    import  - Add the rules of a JSON lines file, or of a CSV file (.csv) with the
+              columns user,obj,env,op, with a single kernel reload:
+              abac policy import FILE
+              JSON lines: {"user": {"dept": "hr"}, "obj": {"dept": "hr"}, "env": {}, "op": "READ"}
+              CSV       : dept=hr ^ level=2,dept=hr,*,READ
+              Invalid entries are reported with their line number"""
 
     check_root()
     check_policy_initialized()
 
     if action == "add":
-        add_rule()
+        add_rule(dry_run)
     elif action == "list":
         list_rules()
     elif action == "delete":
         delete_rule()
+    elif action == "analyze":
+        analyze_rules()
+    elif action == "diff":
+        diff_policies(files)
+    elif action == "import":
+        if len(files) != 1:
+            sys.exit("Usage: abac policy import FILE")
+        import_rules(files[0], skip_invalid)
@@ -0,0 +1,135 @@
+# ABAC object attribute reconciliation
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+import os
+import json
+import click
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from apscheduler.schedulers.blocking import BlockingScheduler
+from .common import check_root
+from .config import CONFIG_ROOT, CONFIG_OWNERS_FILE, SHARED_DIR, RECONCILE_WORKERS
+from .store import get_store
+from .obj import reload_obj_attr
+
+owners_path = CONFIG_ROOT + CONFIG_OWNERS_FILE
+
+def scan_dir(path):
+    """(path, owner uid) of the entries of the directory path, and its subdirectories"""
+    entries = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    # removed while scanning
+                    continue
+                entries.append((entry.path, st.st_uid))
+                if is_dir:
+                    subdirs.append(entry.path)
+    except OSError as e:
+        print(f"Failed to scan {path}\n{e}")
+    return entries, subdirs
+
+def scan_tree(root, workers):
+    """
+    Owner uid of root and of everything below it. Directories are listed with
+    os.scandir by a pool of workers, each subdirectory found being a new task
+    """
+    try:
+        owners = {root: os.stat(root, follow_symlinks=False).st_uid}
+    except OSError:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan_dir, root)}
+        while len(pending) != 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                owners.update(entries)
+                for subdir in subdirs:
+                    pending.add(pool.submit(scan_dir, subdir))
+    return owners
+
+def read_owners():
+    try:
+        with open(owners_path) as f:
+            return json.load(f)["owners"]
+    except FileNotFoundError:
+        return {}
+
+def write_owners(owners):
+    tmp_path = owners_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"owners": owners}, f)
+    os.replace(tmp_path, owners_path)
+
+def reconcile_once(dry_run, workers):
+    """
+    Compare the objects and directories with attributes against the shared directory.
+    Report or remove the entries of paths that no longer exist, with one store update
+    and one kernel reload, and report the objects whose owner changed since the last run
+    """
+    store = get_store()
+    root = str(Path(SHARED_DIR).resolve())
+    owners = scan_tree(root, workers)
+    print(f"Scanned {len(owners)} paths in {root}")
+
+    # paths outside of the shared directory or missed by the scan are checked one by one
+    objects = dict(store.iter_objs())
+    orphans = [p for p in objects if p not in owners and not os.path.lexists(p)]
+    dirs = store.get_dirs()
+    orphan_dirs = [p for p in dirs if p not in owners and not os.path.isdir(p)]
+    for path in orphans:
+        print(f"Orphaned object: {path}")
+    for path in orphan_dirs:
+        print(f"Orphaned directory attributes: {path}")
+
+    # owners of the objects with attributes, as seen by the previous run
+    previous = read_owners()
+    current = {}
+    changed = 0
+    for path in list(objects) + list(dirs):
+        uid = owners.get(path)
+        if uid is None:
+            continue
+        current[path] = uid
+        if path in previous and previous[path] != uid:
+            print(f"Owner changed: {path} {previous[path]} -> {uid}")
+            changed += 1
+
+    if dry_run:
+        print(f"{len(orphans)} orphaned objects, {len(orphan_dirs)} orphaned directories, {changed} owner changes. Nothing removed (dry run)")
+        return
+    write_owners(current)
+    if len(orphans) != 0:
+        store.update_objs({path: {} for path in orphans})
+    for path in orphan_dirs:
+        store.set_dir(path, {})
+    print(f"{len(orphans)} orphaned objects and {len(orphan_dirs)} orphaned directories removed, {changed} owner changes")
+    if len(orphans) != 0 or len(orphan_dirs) != 0:
+        reload_obj_attr()
+
+@click.command()
+@click.option('-n', '--dry-run', 'dry_run', default=False, is_flag=True, help='Only report the orphaned entries and owner changes.')
+@click.option('-w', '--workers', 'workers', type=click.IntRange(1, 64), default=RECONCILE_WORKERS, help='Number of directories scanned in parallel.')
+@click.option('-i', '--interval', 'interval', type=click.IntRange(min=1), default=None, help='Keep running and reconcile every INTERVAL seconds.')
+def reconcile(dry_run, workers, interval):
+    """\b
+    Reconcile the object attributes with the shared directory. YOU MUST BE ROOT TO USE THIS COMMAND
+    Removes the attributes of objects and directories that no longer exist, which the
+    watcher missed, with a single kernel reload, and reports the objects whose owner
+    changed since the last run, since owners are allowed to change object attributes."""
+    check_root()
+    get_store().recover()
+
+    reconcile_once(dry_run, workers)
+    if interval is None:
+        return
+    print(f"Scheduling the reconciler to run every {interval} seconds...")
+    sched = BlockingScheduler()
+    sched.add_job(reconcile_once, 'interval', seconds=interval, args=[dry_run, workers])
+    sched.start()
@@ -0,0 +1,101 @@
+# ABAC coalescing kernel reload scheduler
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Coalesces bursts of kernel reload requests into a single reload.
+"""
+import time
+import threading
+from .config import RELOAD_WINDOW, RELOAD_MAX_LATENCY
+
+class ReloadScheduler:
+    """
+    Runs reload() in a background thread once per burst of requests. A reload starts
+    when no request arrived for window seconds, or max_latency seconds after the first
+    request of the burst, whichever comes first.
+    Every request returns a ticket. Callers that need the reload to be applied can wait
+    for the (first) reload started after their request, which covers the ticket.
+    """
+
+    def __init__(self, reload, window=RELOAD_WINDOW, max_latency=RELOAD_MAX_LATENCY):
+        self.reload = reload
+        self.window = window
+        self.max_latency = max_latency
+        self.cond = threading.Condition()
+        # tickets issued and the last ticket covered by a finished reload
+        self.requested = 0
+        self.completed = 0
+        self.error = None
+        # arrival of the first and the last request of the pending burst
+        self.first_pending = None
+        self.last_pending = None
+        # (ticket, callback) waiting for a reload
+        self.callbacks = []
+        self.reloads = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        """Mark the kernel file dirty. Returns the ticket of this request"""
+        with self.cond:
+            self.requested += 1
+            now = time.monotonic()
+            if self.first_pending is None:
+                self.first_pending = now
+            self.last_pending = now
+            self.cond.notify_all()
+            return self.requested
+
+    def wait(self, ticket):
+        """Block until the reload covering ticket finished. Raises the error of a failed reload"""
+        with self.cond:
+            while self.completed < ticket:
+                self.cond.wait()
+            if self.error is not None:
+                raise self.error
+
+    def subscribe(self, ticket, callback):
+        """
+        Call callback(error) once the reload covering ticket finished. error is None if the
+        reload succeeded. The callback is called from the scheduler thread
+        """
+        with self.cond:
+            if self.completed < ticket:
+                self.callbacks.append((ticket, callback))
+                return
+            error = self.error
+        callback(error)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.first_pending is None:
+                    self.cond.wait()
+                # wait for the burst to end, but no longer than max_latency
+                while True:
+                    deadline = min(self.last_pending + self.window, self.first_pending + self.max_latency)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                ticket = self.requested
+                self.first_pending = None
+            error = None
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"Kernel reload failed\n{e}")
+                error = e
+            with self.cond:
+                self.reloads += 1
+                self.completed = ticket
+                self.error = error
+                done = [cb for t, cb in self.callbacks if t <= ticket]
+                self.callbacks = [(t, cb) for t, cb in self.callbacks if t > ticket]
+                self.cond.notify_all()
+            for callback in done:
+                callback(error)
+
+    def stats(self):
+        with self.cond:
+            return {"requests": self.requested, "reloads": self.reloads}
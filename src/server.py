@@ -3,103 +3,486 @@
 
 import signal
 import os
+import io
 import sys
-import json
+import time
+import struct
+import socket
+import pickle
+import asyncio
+import threading
 import click
 from pathlib import Path
-from multiprocessing.connection import Listener
 from .common import check_root
-from .config import CONFIG_ROOT, CONFIG_AVP_FILE, CONFIG_OBJ_ATTRS_FILE, PORT
+from .config import CONFIG_ROOT, CONFIG_OBJ_ATTRS_FILE, PORT, SERVER_SOCKET, SERVER_MAX_MSG_SIZE
+from .config import RELOAD_WINDOW, RELOAD_MAX_LATENCY
 from .load import load_obj_attr, load_user_attr, load_policy
+from .store import get_store, PathIndex
+from .reload import ReloadScheduler
+from .metrics import registry, render_prometheus
 
-# global listener object
-listener = None
+# actions served. Requests for other actions are counted as UNKNOWN in the metrics
+ACTIONS = ("AVAILABLE", "STATS", "BULK_UPDATE", "LIST", "UPDATE", "RELOAD")
 
 def is_owner(object_path, requester_id):
     if requester_id == 0:
         return True
-    owner_id = os.stat(object_path).st_uid
+    with registry.timer("abac_owner_check_seconds"):
+        owner_id = os.stat(object_path).st_uid
     return requester_id == owner_id
 
 def check_obj_initialized():
     if not Path(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE).is_file():
         sys.exit("ABAC config not initialized. Please run 'abac init' and try again.")
 
-def signal_handler(sig, frame):
-    print("Stopping ABAC object attribute service...")
-    global listener
-    if listener:
-        listener.close()
-    sys.exit()
+class SafeUnpickler(pickle.Unpickler):
+    """Messages only contain builtin containers and strings. Refuse to load anything else"""
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in messages")
+
+async def recv_message(reader):
+    """
+    Read one message sent by a multiprocessing.connection Client. Messages are pickles,
+    prefixed by their length as a signed 32 bit integer or -1 followed by a 64 bit length.
+    """
+    size, = struct.unpack("!i", await reader.readexactly(4))
+    if size == -1:
+        size, = struct.unpack("!Q", await reader.readexactly(8))
+    if size < 0 or size > SERVER_MAX_MSG_SIZE:
+        raise ValueError(f"Invalid message size {size}")
+    data = await reader.readexactly(size)
+    return SafeUnpickler(io.BytesIO(data)).load()
+
+def send_message(writer, msg):
+    """Write one message in the multiprocessing.connection format"""
+    data = pickle.dumps(msg)
+    if len(data) > 0x7fffffff:
+        writer.write(struct.pack("!i", -1) + struct.pack("!Q", len(data)))
+    else:
+        writer.write(struct.pack("!i", len(data)))
+    writer.write(data)
+
+class AttrCache:
+    """
+    Available object attribute-value pairs and object attributes kept in memory by the server.
+    The cache is validated against the signature of the store on every access, so changes
+    made by the root cli commands or the watcher invalidate it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # the cache is read by the event loop and updated by the writer thread.
+        # The lock is never held across a store write, so reads are served during writes
+        self.lock = threading.RLock()
+        # set while the writer thread writes to the store. Reads are served from the cache until it is done
+        self.writing = False
+        self.signature = None
+        self.avps = {}
+        self.objects = {}
+        # sorted paths of the objects, for listing directories
+        self.index = PathIndex()
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        if self.writing or self.store.signature() == self.signature:
+            self.hits += 1
+            return
+        with self.lock:
+            # checked again, another thread may have refreshed the cache while we waited
+            signature = self.store.signature()
+            if self.writing or signature == self.signature:
+                self.hits += 1
+                return
+            self.misses += 1
+            # read after taking the signature, so a change made while reading invalidates the cache again
+            with registry.timer("abac_store_read_seconds"):
+                avps = self.store.get_avps()["obj"]
+                objects = dict(self.store.iter_objs())
+                index = PathIndex(objects.keys())
+            # publish the new dicts together. Readers holding the old ones aren't affected
+            self.avps, self.objects, self.index = avps, objects, index
+            self.signature = signature
+
+    def get_avps(self):
+        self.refresh()
+        return self.avps
+
+    def get_obj(self, path):
+        self.refresh()
+        return self.objects.get(path, {})
+
+    def set_obj(self, path, avps):
+        self.update_objs({path: avps})
+
+    def update_objs(self, updates, merge=False):
+        """
+        Set the attributes of many objects with a single store write. If merge is set,
+        the given avps are added to the existing attributes of each object
+        """
+        # only the writer thread writes, so the cache doesn't change until the write is applied below
+        with self.lock:
+            self.refresh()
+            if merge:
+                merged = {}
+                for path, avps in updates.items():
+                    merged[path] = dict(self.objects.get(path, {}))
+                    merged[path].update(avps)
+                updates = merged
+            expected = self.signature
+            self.writing = True
+        try:
+            with registry.timer("abac_store_write_seconds"):
+                signature = self.store.update_objs_signed(updates, expected)
+        except BaseException:
+            with self.lock:
+                self.writing = False
+                self.signature = None
+            raise
+        with self.lock:
+            self.writing = False
+            if signature is None:
+                # another process wrote to the store since the last refresh. The next access reads it all again
+                self.signature = None
+                return
+            for path, avps in updates.items():
+                if len(avps) == 0:
+                    self.objects.pop(path, None)
+                    self.index.remove(path)
+                else:
+                    self.objects[path] = avps
+                    self.index.add(path)
+            # the cache was up to date right before the write and holds the write now,
+            # so our own write doesn't invalidate it
+            self.signature = signature
+
+    def objs_under(self, prefix):
+        """(path, avps) of the object at prefix and of the objects below it"""
+        with self.lock:
+            self.refresh()
+            return [(path, self.objects[path]) for path in self.index.under(prefix)]
+
+    def snapshot(self):
+        """(path, avps) of all objects, safe to iterate while the cache is updated"""
+        with self.lock:
+            self.refresh()
+            return list(self.objects.items())
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "objects": len(self.objects)}
+
+# cache of the attributes served by the server. Created when the server starts
+cache = None
+# coalesces the kernel reloads of object updates. Created when the server starts
+reloads = None
 
 def get_available_avps():
-    with open(CONFIG_ROOT + CONFIG_AVP_FILE) as f:
-        avps = json.load(f)["obj"]
-    return avps
+    return cache.get_avps()
 
 def list_attr(path):
-    with open(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE) as f:
-        attrs = json.load(f)["objects"]
-        if path not in attrs:
-            return {}
-        return attrs[path]
+    return cache.get_obj(path)
+
+def list_attr_under(path, uid):
+    """Attributes of the objects at and below path owned by uid. Objects whose file is gone are skipped"""
+    objects = {}
+    for obj_path, avps in cache.objs_under(path):
+        try:
+            if is_owner(obj_path, uid):
+                objects[obj_path] = avps
+        except OSError:
+            continue
+    return objects
+
+def unowned_below(path, uid):
+    """
+    The first path at or below the directory path that uid doesn't own, or None.
+    Symlinks are checked themselves and never followed
+    """
+    if uid == 0:
+        return None
+    for root, dirs, files in os.walk(path):
+        for p in [root] + [os.path.join(root, name) for name in dirs + files]:
+            try:
+                if os.lstat(p).st_uid != uid:
+                    return p
+            except FileNotFoundError:
+                continue
+    return None
+
+def list_dir_attr(path):
+    return cache.store.get_dirs().get(path, {})
+
+def update_dir_attr(path, avps):
+    # empty avps removes the directory attributes
+    cache.store.set_dir(path, avps)
+    # everything below the directory inherits the attributes. Reload them into the kernel
+    return reloads.request()
 
 def update_attr(path, avps):
-    with open(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE) as f:
-        attrs = json.load(f)
-    if len(avps) == 0:
-        del attrs["objects"][path]
+    # empty avps removes the object from the store
+    cache.set_obj(path, avps)
+    # schedule a reload of the object attributes into the kernel.
+    # The returned ticket is used to wait for the reload
+    return reloads.request()
+
+def bulk_update_attr(updates, merge):
+    cache.update_objs(updates, merge)
+    return reloads.request()
+
+def check_bulk_update(updates, uid):
+    """Returns an error message if the requester can't apply any of the updates"""
+    available = cache.get_avps()
+    for path, avps in updates.items():
+        if not isinstance(avps, dict):
+            return f"Invalid attributes for {path}"
+        for name, value in avps.items():
+            if value not in available.get(name, []):
+                return f"Invalid attribute-value pair {name}={value} for {path}"
+        try:
+            if not is_owner(path, uid):
+                return f"You are not the owner of {path}"
+        except OSError:
+            return f"{path} not found"
+    return None
+
+def request_reload():
+    return reloads.request()
+
+def reload_obj_attr():
+    with registry.timer("abac_reload_seconds"):
+        load_obj_attr(objects=cache.snapshot())
+
+def get_stats():
+    cache_stats = cache.stats()
+    reload_stats = reloads.stats()
+    # exported as gauges as well, so that they show up in the prometheus dump
+    registry.set("abac_cache_hits", cache_stats["hits"])
+    registry.set("abac_cache_misses", cache_stats["misses"])
+    registry.set("abac_cache_objects", cache_stats["objects"])
+    registry.set("abac_reload_requests", reload_stats["requests"])
+    registry.set("abac_reloads", reload_stats["reloads"])
+    return {"cache": cache_stats, "reloads": reload_stats, "metrics": registry.snapshot()}
+
+async def dump_metrics(path, interval):
+    """Write the metrics to path in the Prometheus text format every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(render_prometheus(get_stats()["metrics"]))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write metrics to {path}\n{e}")
+
+class AttrServer:
+    """
+    Serves many clients at once. Reads are answered from the cache by the event loop, while
+    writes are queued and applied one at a time by the writer task in a worker thread, so a
+    slow kernel reload doesn't stall the readers. Kernel reloads of bursts of writes are
+    coalesced. Writers get their reply once the write is in the store and the kernel.
+    """
+
+    def __init__(self):
+        self.writes = asyncio.Queue()
+
+    async def writer(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            func, args, future = await self.writes.get()
+            try:
+                future.set_result(await loop.run_in_executor(None, func, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+    async def write(self, func, *args):
+        future = asyncio.get_event_loop().create_future()
+        await self.writes.put((func, args, future))
+        registry.set("abac_write_queue_depth", self.writes.qsize())
+        try:
+            return await future
+        finally:
+            registry.set("abac_write_queue_depth", self.writes.qsize())
+
+    async def blocking(self, func, *args):
+        """Run func in a worker thread, so that its stat calls and cache refresh don't stall other clients"""
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def wait_reload(self, ticket):
+        """Wait for the kernel reload covering ticket"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        def done(error):
+            loop.call_soon_threadsafe(set_future, future, error)
+        reloads.subscribe(ticket, done)
+        await future
+
+    async def update(self, func, *args):
+        ticket = await self.write(func, *args)
+        try:
+            await self.wait_reload(ticket)
+        except Exception as e:
+            return {"error": f"Attributes saved, but loading them into the kernel failed\n{e}"}
+        return {"status": "OK"}
+
+    async def handle(self, msg, peer_uid=None):
+        """
+        Returns the reply for msg, or None if the message is invalid. peer_uid is the uid of the
+        client verified by the kernel. If it is None, the uid sent by the client is trusted
+        """
+        # each message MUST have the action key
+        if not isinstance(msg, dict) or 'action' not in msg:
+            return None
+        if peer_uid is not None:
+            msg["uid"] = peer_uid
+        if msg["action"] == "AVAILABLE":
+            return {"avps" : await self.blocking(get_available_avps)}
+        if msg["action"] == "STATS":
+            return {"stats" : get_stats()}
+        if 'uid' not in msg:
+            # for remaining actions, the UID is required to check for ownership
+            return None
+        if msg["action"] == "BULK_UPDATE":
+            if not isinstance(msg.get("updates"), dict):
+                return None
+            # all objects are checked before anything is written
+            error = await self.blocking(check_bulk_update, msg["updates"], msg["uid"])
+            if error:
+                return {"error": error}
+            payload = await self.update(bulk_update_attr, msg["updates"], msg.get("merge", False))
+            if "error" not in payload:
+                payload["count"] = len(msg["updates"])
+            return payload
+        if msg["action"] == "RELOAD":
+            # reload the object attributes changed in the store by a root cli command,
+            # after the reloads of the writes already queued
+            if msg["uid"] != 0:
+                return {"error": "Only root can reload the object attributes"}
+            return await self.update(request_reload)
+        if not is_owner(msg["object"], msg['uid']):
+            return {"error": "You are not the owner of this object"}
+        if msg["action"] == "LIST":
+            # the cache and the store are read off the event loop
+            if msg.get("dir"):
+                return {"avps" : await self.blocking(list_dir_attr, msg["object"])}
+            if msg.get("recursive"):
+                return {"objects" : await self.blocking(list_attr_under, msg["object"], msg["uid"])}
+            return {"avps" : await self.blocking(list_attr, msg["object"])}
+        if msg["action"] == "UPDATE" and msg.get("dir"):
+            if not os.path.isdir(msg["object"]):
+                return {"error": f"{msg['object']} is not a directory"}
+            # everything below the directory inherits its attributes, which grants or
+            # revokes access to it. Only a requester owning all of it may change them
+            unowned = await self.blocking(unowned_below, msg["object"], msg["uid"])
+            if unowned is not None:
+                return {"error": f"You are not the owner of {unowned}, which inherits the attributes of {msg['object']}"}
+            return await self.update(update_dir_attr, msg["object"], msg["avps"])
+        if msg["action"] == "UPDATE":
+            return await self.update(update_attr, msg["object"], msg["avps"])
+        return {"error": f"Unknown action {msg['action']}"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            peer_uid = get_peer_uid(writer)
+            msg = await recv_message(reader)
+            print(msg)
+            start = time.perf_counter()
+            payload = await self.handle(msg, peer_uid)
+            if payload is None:
+                action = "INVALID"
+            elif isinstance(msg["action"], str) and msg["action"] in ACTIONS:
+                action = msg["action"]
+            else:
+                # clients pick the action, so unknown ones share a series
+                action = "UNKNOWN"
+            labels = (("action", action),)
+            registry.inc("abac_requests_total", labels)
+            registry.observe("abac_request_seconds", time.perf_counter() - start, labels)
+            if payload is None:
+                print("Invalid message. Connection closed\n", msg)
+                return
+            print(payload)
+            send_message(writer, payload)
+            await writer.drain()
+        except Exception as e:
+            print("Failed to handle request\n", e)
+        finally:
+            writer.close()
+
+def get_peer_uid(writer):
+    """uid of the process on the other end of a unix socket, None for TCP connections"""
+    sock = writer.get_extra_info('socket')
+    if sock.family != socket.AF_UNIX:
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+def create_socket_dir():
+    Path(SERVER_SOCKET).parent.mkdir(parents=True, exist_ok=True)
+    # remove the socket left behind by a previous run
+    if Path(SERVER_SOCKET).exists():
+        os.remove(SERVER_SOCKET)
+
+def set_future(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
     else:
-        attrs["objects"][path] = avps
-    with open(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE, 'w') as f:
-        json.dump(attrs, f)
-    # reload the object attributes into the kernel
-    load_obj_attr()
-    return "OK"
+        future.set_exception(error)
+
+def stop(loop):
+    print("Stopping ABAC object attribute service...")
+    loop.stop()
 
 @click.command()
-def server():
+@click.option('-f', '--force', default=False, is_flag=True, help='Reload attributes and policy at startup, even if the kernel already holds them.')
+@click.option('--reload-window', default=int(RELOAD_WINDOW * 1000), show_default=True, help='Object updates arriving within this many milliseconds of each other share one kernel reload.')
+@click.option('--reload-max-latency', default=int(RELOAD_MAX_LATENCY * 1000), show_default=True, help='Upper bound in milliseconds on how long a reload is delayed by a burst of updates.')
+@click.option('--tcp', default=False, is_flag=True, help=f'Also listen on localhost:{PORT}. TCP clients are trusted to send their own uid.')
+@click.option('--metrics-file', type=str, help='Periodically write the server metrics to this file in the Prometheus text format.')
+@click.option('--metrics-interval', default=15, show_default=True, help='Seconds between two writes of the metrics file.')
+def server(force, reload_window, reload_max_latency, tcp, metrics_file, metrics_interval):
     """
     Starts the ABAC attribute server. This server is responsible for managing object attributes.
     This server is started automatically by the system.
     """
     check_root()
     check_obj_initialized()
+    # replay updates left in the store journal by a crash
+    get_store().recover()
+    global cache, reloads
+    cache = AttrCache(get_store())
+    reloads = ReloadScheduler(reload_obj_attr, reload_window / 1000, reload_max_latency / 1000)
 
     # load attributes into the kernel
-    load_user_attr()
-    load_obj_attr()
-    load_policy()
+    load_user_attr(force)
+    load_obj_attr(force)
+    load_policy(force)
     print("Attributes loaded into the kernel")
 
-    address = ('localhost', 4848)
-    signal.signal(signal.SIGINT, signal_handler)
-    print(f"ABAC Object attribute service listening on {address[0]}:{address[1]}")
-    with Listener(address) as listener:
-        while True:
-            with listener.accept() as conn:
-                msg = conn.recv()
-                print(msg)
-                # each message MUST have the action key
-                if 'action' not in msg:
-                    print("Invalid message. Connection closed\n", msg)
-                    conn.close()
-                    continue
-                if msg["action"] == "AVAILABLE":
-                    payload = {"avps" : get_available_avps()}
-                elif 'uid' not in msg:
-                    # for remaining actions, the UID is required to check for ownership
-                    print("Invalid message. Connection closed\n", msg)
-                    conn.close()
-                    continue
-                elif not is_owner(msg["object"], msg['uid']):
-                    payload = {"error": "You are not the owner of this object"}
-                elif msg["action"] == "LIST":
-                    payload = {"avps" : list_attr(msg["object"])}
-                elif msg["action"] == "UPDATE":
-                    payload = {"status" : update_attr(msg["object"], msg["avps"])}
-                print(payload)
-                conn.send(payload)
-                conn.close()
-    # the loop never comes here. listener is closed by the signal handler
-    listener.close()
+    loop = asyncio.get_event_loop()
+    attr_server = AttrServer()
+    create_socket_dir()
+    listeners = [loop.run_until_complete(asyncio.start_unix_server(attr_server.handle_connection, SERVER_SOCKET))]
+    # every user may connect. Requests are checked against the uid of the connecting process
+    os.chmod(SERVER_SOCKET, 0o666)
+    print(f"ABAC Object attribute service listening on {SERVER_SOCKET}")
+    if tcp:
+        address = ('localhost', PORT)
+        listeners.append(loop.run_until_complete(asyncio.start_server(attr_server.handle_connection, address[0], address[1])))
+        print(f"ABAC Object attribute service listening on {address[0]}:{address[1]}")
+        print("Warning: requests over TCP are trusted to carry the uid of the requester")
+    loop.create_task(attr_server.writer())
+    if metrics_file:
+        loop.create_task(dump_metrics(metrics_file, metrics_interval))
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, stop, loop)
+    try:
+        loop.run_forever()
+    finally:
+        for listener in listeners:
+            listener.close()
+            loop.run_until_complete(listener.wait_closed())
+        loop.close()
@@ -0,0 +1,43 @@
+# ABAC attribute server statistics
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+import sys
+import click
+from . import obj
+from .metrics import render_prometheus
+
+def print_histograms(histograms):
+    for name, series in sorted(histograms.items()):
+        for labels, h in series:
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            avg = h["sum"] / h["count"] if h["count"] else 0
+            # durations are observed in seconds, everything else is printed as is
+            avg = f"{avg * 1000:.3f}ms" if name.endswith("_seconds") else f"{avg:.0f}"
+            print(f"{name}{'{' + label + '}' if label else ''}: count={h['count']} avg={avg}")
+
+@click.command()
+@click.option('--prometheus', default=False, is_flag=True, help="Print the metrics in the Prometheus text format.")
+@click.option('--tcp', default=False, is_flag=True, help="Connect to the attribute server over TCP.")
+def stats(prometheus, tcp):
+    """
+    Show statistics of the running ABAC attribute server: requests and latencies per action,
+    store and kernel write timings, cache hits and kernel reloads.
+    """
+    obj.use_tcp = tcp
+    try:
+        msg = obj.request({"action": "STATS"})
+    except (ConnectionError, FileNotFoundError):
+        sys.exit("Failed to connect to the ABAC object attribute service. Please make sure that it is running.")
+    if "error" in msg:
+        sys.exit(f"The following error occured\n{msg['error']}")
+    stats = msg["stats"]
+    if prometheus:
+        print(render_prometheus(stats["metrics"]), end="")
+        return
+    print(f"Cache: {stats['cache']['hits']} hits, {stats['cache']['misses']} misses, {stats['cache']['objects']} objects")
+    print(f"Kernel reloads: {stats['reloads']['reloads']} reloads for {stats['reloads']['requests']} requests")
+    for name, series in sorted(stats["metrics"]["counters"].items()):
+        for labels, value in series:
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            print(f"{name}{'{' + label + '}' if label else ''}: {value}")
+    print_histograms(stats["metrics"]["histograms"])
@@ -0,0 +1,683 @@
+# ABAC attribute and policy store
+# Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
+
+"""
+Storage backends for the user, object attributes, attribute-value pairs and policy.
+JSONStore keeps them in the original json files in CONFIG_ROOT. SQLiteStore keeps
+them in a single indexed SQLite database, so that single object/user lookups and
+updates don't require parsing and rewriting the whole store.
+
+Object attribute updates of the JSONStore are appended to a journal, which is
+merged with obj_attr.json on every read and folded into it once it grows too large.
+"""
+import os
+import sys
+import json
+import fcntl
+import sqlite3
+import threading
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from pathlib import Path
+from .config import CONFIG_ROOT, CONFIG_USER_ATTRS_FILE, CONFIG_OBJ_ATTRS_FILE
+from .config import CONFIG_POLICY_FILE, CONFIG_AVP_FILE, CONFIG_DB_FILE, STORE_BACKEND
+from .config import CONFIG_OBJ_JOURNAL_FILE, CONFIG_OBJ_LOCK_FILE, CONFIG_DIR_ATTRS_FILE
+from .config import OBJ_JOURNAL_ENABLED, OBJ_JOURNAL_COMPACT_SIZE
+
+def prefix_range(prefix):
+    """
+    Returns (low, high) such that every path strictly below the directory prefix
+    satisfies low < path < high. '0' is the character following '/'
+    """
+    prefix = prefix.rstrip("/")
+    return prefix + "/", prefix + "0"
+
+def stat_signature(paths):
+    """(inode, mtime, size) of every path, None for missing ones"""
+    sig = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            sig.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+def is_under(path, prefix):
+    """Returns True if path is prefix or is inside the directory prefix"""
+    prefix = prefix.rstrip("/")
+    return path == prefix or path.startswith(prefix + "/")
+
+class PathIndex:
+    """
+    Sorted list of object paths. The paths below a directory are contiguous in it, so
+    listing them costs O(log n + number of paths below) instead of a scan of all paths
+    """
+
+    def __init__(self, paths=()):
+        self.paths = sorted(paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path):
+        i = bisect_left(self.paths, path)
+        if i == len(self.paths) or self.paths[i] != path:
+            self.paths.insert(i, path)
+
+    def remove(self, path):
+        i = bisect_left(self.paths, path)
+        if i < len(self.paths) and self.paths[i] == path:
+            del self.paths[i]
+
+    def under(self, prefix):
+        """The path prefix, if indexed, and the paths below the directory prefix, sorted"""
+        prefix = prefix.rstrip("/")
+        low, high = prefix_range(prefix)
+        i = bisect_left(self.paths, prefix)
+        if i < len(self.paths) and self.paths[i] == prefix:
+            yield prefix
+        for i in range(bisect_right(self.paths, low), bisect_left(self.paths, high)):
+            yield self.paths[i]
+
+class Store:
+    """
+    Subtree operations shared by the backends, built on objs_under and update_objs.
+    They write their changes at once, or add them to a pending updates dict given by a
+    caller batching many of them into one update_objs. The pending updates are then
+    read over the store, so each operation sees the changes of the previous ones
+    """
+
+    def pending_under(self, prefix, pending):
+        """(path, avps) of the objects at or below prefix, with the pending updates applied"""
+        found = dict(self.objs_under(prefix))
+        for path, avps in pending.items():
+            if is_under(path, prefix):
+                found[path] = avps
+        return [(path, avps) for path, avps in found.items() if avps]
+
+    def delete_prefix(self, prefix, pending=None):
+        """Remove the object at prefix and every object below it. Returns the number of objects removed"""
+        updates = {} if pending is None else pending
+        objects = self.pending_under(prefix, updates)
+        for path, _ in objects:
+            updates[path] = {}
+        if pending is None:
+            self.update_objs(updates)
+        return len(objects)
+
+    def rename_prefix(self, src, dest, pending=None):
+        """Move the object at src and every object below it to dest. Returns the number of objects moved"""
+        src = src.rstrip("/")
+        dest = dest.rstrip("/")
+        updates = {} if pending is None else pending
+        objects = self.pending_under(src, updates)
+        for path, _ in objects:
+            updates[path] = {}
+        for path, avps in objects:
+            updates[dest + path[len(src):]] = avps
+        if pending is None:
+            self.update_objs(updates)
+        return len(objects)
+
+class JSONStore(Store):
+    """
+    Stores everything in the json files in the config root directory.
+    If journal is set, object updates are appended to the object journal, one json
+    record per line. Reads replay the journal over obj_attr.json, and the journal is
+    compacted into obj_attr.json in the background once it is larger than compact_size.
+    """
+
+    name = "json"
+
+    def __init__(self, root=CONFIG_ROOT, journal=OBJ_JOURNAL_ENABLED, compact_size=OBJ_JOURNAL_COMPACT_SIZE):
+        self.user_attr_path = root + CONFIG_USER_ATTRS_FILE
+        self.obj_attr_path = root + CONFIG_OBJ_ATTRS_FILE
+        self.dir_attr_path = root + CONFIG_DIR_ATTRS_FILE
+        self.policy_path = root + CONFIG_POLICY_FILE
+        self.avp_path = root + CONFIG_AVP_FILE
+        self.journal_path = root + CONFIG_OBJ_JOURNAL_FILE
+        self.lock_path = root + CONFIG_OBJ_LOCK_FILE
+        self.journal = journal
+        self.compact_size = compact_size
+        self.compactor = None
+        # (stat of user_attr.json, users, reverse index of the user attributes)
+        self.users_cache = None
+        # (stat of obj_attr.json and the journal, objects)
+        self.objs_cache = None
+        # (objects, PathIndex of their paths), built on the first subtree lookup
+        self.paths_cache = None
+
+    def read(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def write(self, path, data):
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    def replace(self, path, data):
+        """
+        Write data under a temporary name and rename it over path, so that readers
+        and a crash see either the old or the new file, never a partial one
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        """Remove all users, objects and directory attributes"""
+        self.write(self.user_attr_path, {"users": {}})
+        with self.locked(fcntl.LOCK_EX):
+            self.replace(self.dir_attr_path, {"dirs": {}})
+            self.write(self.obj_attr_path, {"objects": {}})
+            self.truncate_journal()
+
+    def signature(self):
+        """Changes whenever the object attributes or attribute-value pairs are modified"""
+        return stat_signature([self.obj_attr_path, self.journal_path, self.avp_path])
+
+    def recover(self):
+        """Fold the journal left behind by a previous run into obj_attr.json"""
+        if self.journal and self.journal_size() > 0:
+            self.compact()
+
+    # object attributes
+    @contextmanager
+    def locked(self, mode):
+        """
+        Lock the object attributes across processes. Readers share the lock,
+        while appending to and compacting the journal are exclusive
+        """
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except OSError:
+            return 0
+
+    def truncate_journal(self):
+        if Path(self.journal_path).is_file():
+            open(self.journal_path, 'w').close()
+
+    def replay(self, objects):
+        """Apply the journal records to the objects dict"""
+        if not Path(self.journal_path).is_file():
+            return
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write of a crashed process. Its update was never acknowledged
+                    continue
+                if len(record["avps"]) == 0:
+                    objects.pop(record["path"], None)
+                else:
+                    objects[record["path"]] = record["avps"]
+
+    def read_objs(self):
+        """obj_attr.json merged with the journal"""
+        with self.locked(fcntl.LOCK_SH):
+            data = self.read(self.obj_attr_path)
+            if self.journal:
+                self.replay(data["objects"])
+        return data
+
+    def objects(self):
+        """
+        The objects dict of read_objs, cached until obj_attr.json or the journal change.
+        It is shared by the callers and must not be modified
+        """
+        # stat before reading, so that a concurrent update invalidates what we read
+        stat = stat_signature([self.obj_attr_path, self.journal_path])
+        cache = self.objs_cache
+        if cache is not None and cache[0] == stat:
+            return cache[1]
+        objects = self.read_objs()["objects"]
+        self.objs_cache = (stat, objects)
+        return objects
+
+    def compact(self):
+        """Fold the journal into a new obj_attr.json snapshot and empty the journal"""
+        with self.locked(fcntl.LOCK_EX):
+            data = self.read(self.obj_attr_path)
+            self.replay(data["objects"])
+            # a crash leaves either the old snapshot and the journal or the new snapshot behind.
+            # Replaying the journal over the new snapshot is harmless.
+            self.replace(self.obj_attr_path, data)
+            self.truncate_journal()
+
+    def compact_in_background(self):
+        if self.compactor is not None and self.compactor.is_alive():
+            return
+        self.compactor = threading.Thread(target=self.compact, daemon=True)
+        self.compactor.start()
+
+    def get_obj(self, path):
+        return dict(self.objects().get(path, {}))
+
+    def set_obj(self, path, avps):
+        """Set the attributes of an object. Empty avps removes the object"""
+        self.update_objs({path: avps})
+
+    def update_objs(self, updates):
+        """Set the attributes of many objects at once. Objects with empty avps are removed"""
+        self.update_objs_signed(updates, None)
+
+    def update_objs_signed(self, updates, expected):
+        """
+        update_objs, returning the signature of the store after the write if it had the
+        expected signature right before it, or None if another process changed it meanwhile
+        """
+        with self.locked(fcntl.LOCK_EX):
+            current = self.signature() == expected
+            size = self.write_objs(updates)
+            signature = self.signature()
+        if size > self.compact_size:
+            self.compact_in_background()
+        return signature if current else None
+
+    def write_objs(self, updates):
+        """Write updates to the journal, or to obj_attr.json. Called with the lock held. Returns the journal size"""
+        if len(updates) == 0:
+            return 0
+        if not self.journal:
+            data = self.read(self.obj_attr_path)
+            for path, avps in updates.items():
+                if len(avps) == 0:
+                    data["objects"].pop(path, None)
+                else:
+                    data["objects"][path] = avps
+            self.write(self.obj_attr_path, data)
+            return 0
+
+        records = "".join(json.dumps({"path": path, "avps": avps}) + "\n" for path, avps in updates.items())
+        with open(self.journal_path, 'ab') as f:
+            # terminate a torn record of a crashed process, so that it doesn't swallow ours
+            if f.tell() > 0:
+                with open(self.journal_path, 'rb') as r:
+                    r.seek(-1, os.SEEK_END)
+                    if r.read(1) != b"\n":
+                        f.write(b"\n")
+            f.write(records.encode())
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def iter_objs(self):
+        return iter(self.objects().items())
+
+    def count_objs(self):
+        return len(self.objects())
+
+    def path_index(self):
+        """objects() and the sorted index of its paths"""
+        objects = self.objects()
+        cache = self.paths_cache
+        if cache is None or cache[0] is not objects:
+            cache = (objects, PathIndex(objects.keys()))
+            self.paths_cache = cache
+        return cache
+
+    def objs_under(self, prefix):
+        objects, index = self.path_index()
+        for path in index.under(prefix):
+            yield path, objects[path]
+
+    def objs_with(self, attr, value):
+        for path, avps in self.iter_objs():
+            if avps.get(attr) == value:
+                yield path, avps
+
+    # directory attributes
+    def get_dirs(self):
+        """attributes inherited by everything below each directory. Initialized on first use"""
+        try:
+            return self.read(self.dir_attr_path)["dirs"]
+        except FileNotFoundError:
+            return {}
+
+    def set_dir(self, path, avps):
+        """Set the attributes of a directory. Empty avps removes them"""
+        # the server, the watcher and the cli may set directories at the same time.
+        # Read and write under the lock, so that none of their changes is lost
+        with self.locked(fcntl.LOCK_EX):
+            dirs = self.get_dirs()
+            if len(avps) == 0:
+                dirs.pop(path, None)
+            else:
+                dirs[path] = avps
+            self.replace(self.dir_attr_path, {"dirs": dirs})
+
+    # user attributes
+    def get_user(self, username):
+        return self.read(self.user_attr_path)["users"].get(username)
+
+    def set_user(self, username, data):
+        self.update_users({username: data})
+
+    def update_users(self, updates):
+        """Set the data of many users at once. Users with None data are removed"""
+        users = self.read(self.user_attr_path)
+        for username, data in updates.items():
+            if data is None:
+                users["users"].pop(username, None)
+            else:
+                users["users"][username] = data
+        self.write(self.user_attr_path, users)
+
+    def delete_user(self, username):
+        users = self.read(self.user_attr_path)
+        if users["users"].pop(username, None) is None:
+            return False
+        self.write(self.user_attr_path, users)
+        return True
+
+    def iter_users(self):
+        return iter(self.read(self.user_attr_path)["users"].items())
+
+    def count_users(self):
+        return len(self.read(self.user_attr_path)["users"])
+
+    def user_by_uid(self, uid):
+        for username, data in self.iter_users():
+            if data["uid"] == uid:
+                return username, data
+        return None
+
+    def user_index(self):
+        """
+        The users and a reverse index mapping (attr, value) to the sorted names of the
+        users holding it. Both are cached until user_attr.json changes
+        """
+        st = os.stat(self.user_attr_path)
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self.users_cache is None or self.users_cache[0] != stat:
+            users = self.read(self.user_attr_path)["users"]
+            index = {}
+            for username, data in users.items():
+                for pair in data["avps"].items():
+                    index.setdefault(pair, []).append(username)
+            for usernames in index.values():
+                usernames.sort()
+            self.users_cache = (stat, users, index)
+        return self.users_cache[1], self.users_cache[2]
+
+    def users_with(self, attr, value):
+        users, index = self.user_index()
+        for username in index.get((attr, value), []):
+            yield username, users[username]
+
+    # attribute-value pairs
+    def get_avps(self):
+        return self.read(self.avp_path)
+
+    def set_avps(self, avps):
+        # under the object lock, as the attribute-value pairs are part of the signature
+        with self.locked(fcntl.LOCK_EX):
+            self.write(self.avp_path, avps)
+
+    # policy
+    def get_rules(self):
+        return self.read(self.policy_path)["rules"]
+
+    def set_rules(self, rules):
+        self.write(self.policy_path, {"rules": rules})
+
+    def add_rules(self, rules):
+        self.set_rules(self.get_rules() + list(rules))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT PRIMARY KEY,
+    avps TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS obj_attrs (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS obj_attrs_avp ON obj_attrs (name, value);
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    uid INTEGER NOT NULL,
+    avps TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_uid ON users (uid);
+CREATE TABLE IF NOT EXISTS user_attrs (
+    username TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (username, name)
+);
+CREATE INDEX IF NOT EXISTS user_attrs_avp ON user_attrs (name, value);
+CREATE TABLE IF NOT EXISTS avps (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    vals TEXT NOT NULL,
+    UNIQUE (type, name)
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    avps TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rules (
+    id INTEGER PRIMARY KEY,
+    rule TEXT NOT NULL
+);
+"""
+
+class SQLiteStore(Store):
+    """
+    Stores everything in an SQLite database. Objects and users are indexed by path,
+    username, uid and attribute=value. Every update is a single transaction.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path=CONFIG_ROOT + CONFIG_DB_FILE):
+        self.db_path = db_path
+        # the server uses the store from more than one thread. Access is serialized by lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def signature(self):
+        """
+        Changes whenever the database is modified. data_version changes on commits of
+        other connections and total_changes on commits of this connection
+        """
+        with self.lock:
+            return (self.conn.execute("PRAGMA data_version").fetchone()[0], self.conn.total_changes)
+
+    def recover(self):
+        """SQLite recovers from crashes by itself"""
+        pass
+
+    def clear(self):
+        """Remove all users, objects and directory attributes"""
+        with self.lock, self.conn:
+            for table in ["objects", "obj_attrs", "users", "user_attrs", "dirs"]:
+                self.conn.execute(f"DELETE FROM {table}")
+
+    # object attributes
+    def get_obj(self, path):
+        rows = self.query("SELECT avps FROM objects WHERE path = ?", (path,))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def set_obj(self, path, avps):
+        """Set the attributes of an object. Empty avps removes the object"""
+        self.update_objs({path: avps})
+
+    def _set_obj(self, path, avps):
+        self.conn.execute("DELETE FROM obj_attrs WHERE path = ?", (path,))
+        if len(avps) == 0:
+            self.conn.execute("DELETE FROM objects WHERE path = ?", (path,))
+            return
+        self.conn.execute("INSERT OR REPLACE INTO objects (path, avps) VALUES (?, ?)", (path, json.dumps(avps)))
+        self.conn.executemany("INSERT INTO obj_attrs (path, name, value) VALUES (?, ?, ?)",
+                [(path, name, value) for name, value in avps.items()])
+
+    def update_objs(self, updates):
+        """Set the attributes of many objects in one transaction. Objects with empty avps are removed"""
+        self.update_objs_signed(updates, None)
+
+    def update_objs_signed(self, updates, expected):
+        """
+        update_objs, returning the signature of the store after the write if it had the
+        expected signature right before it, or None if another process changed it meanwhile
+        """
+        with self.lock, self.conn:
+            # take the write lock first, so that no other process commits until we do
+            self.conn.execute("BEGIN IMMEDIATE")
+            current = self.signature() == expected
+            for path, avps in updates.items():
+                self._set_obj(path, avps)
+            # data_version doesn't change on our own commit, and total_changes is final
+            signature = self.signature()
+        return signature if current else None
+
+    def iter_objs(self):
+        for path, avps in self.query("SELECT path, avps FROM objects ORDER BY path"):
+            yield path, json.loads(avps)
+
+    def count_objs(self):
+        return self.query("SELECT COUNT(*) FROM objects")[0][0]
+
+    def objs_under(self, prefix):
+        low, high = prefix_range(prefix)
+        rows = self.query("SELECT path, avps FROM objects WHERE path = ? OR (path > ? AND path < ?) ORDER BY path",
+                (prefix.rstrip("/"), low, high))
+        for path, avps in rows:
+            yield path, json.loads(avps)
+
+    def objs_with(self, attr, value):
+        rows = self.query("SELECT o.path, o.avps FROM obj_attrs a JOIN objects o ON o.path = a.path "
+                "WHERE a.name = ? AND a.value = ? ORDER BY o.path", (attr, value))
+        for path, avps in rows:
+            yield path, json.loads(avps)
+
+    # directory attributes
+    def get_dirs(self):
+        return {path: json.loads(avps) for path, avps in self.query("SELECT path, avps FROM dirs ORDER BY path")}
+
+    def set_dir(self, path, avps):
+        """Set the attributes of a directory. Empty avps removes them"""
+        with self.lock, self.conn:
+            if len(avps) == 0:
+                self.conn.execute("DELETE FROM dirs WHERE path = ?", (path,))
+            else:
+                self.conn.execute("INSERT OR REPLACE INTO dirs (path, avps) VALUES (?, ?)", (path, json.dumps(avps)))
+
+    # user attributes
+    def get_user(self, username):
+        rows = self.query("SELECT uid, avps FROM users WHERE username = ?", (username,))
+        if not rows:
+            return None
+        return {"uid": rows[0][0], "avps": json.loads(rows[0][1])}
+
+    def set_user(self, username, data):
+        self.update_users({username: data})
+
+    def update_users(self, updates):
+        """Set the data of many users in one transaction. Users with None data are removed"""
+        with self.lock, self.conn:
+            for username, data in updates.items():
+                self.conn.execute("DELETE FROM user_attrs WHERE username = ?", (username,))
+                if data is None:
+                    self.conn.execute("DELETE FROM users WHERE username = ?", (username,))
+                    continue
+                self.conn.execute("INSERT OR REPLACE INTO users (username, uid, avps) VALUES (?, ?, ?)",
+                        (username, data["uid"], json.dumps(data["avps"])))
+                self.conn.executemany("INSERT INTO user_attrs (username, name, value) VALUES (?, ?, ?)",
+                        [(username, name, value) for name, value in data["avps"].items()])
+
+    def delete_user(self, username):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM user_attrs WHERE username = ?", (username,))
+            return self.conn.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount > 0
+
+    def iter_users(self):
+        for username, uid, avps in self.query("SELECT username, uid, avps FROM users ORDER BY username"):
+            yield username, {"uid": uid, "avps": json.loads(avps)}
+
+    def count_users(self):
+        return self.query("SELECT COUNT(*) FROM users")[0][0]
+
+    def user_by_uid(self, uid):
+        rows = self.query("SELECT username, uid, avps FROM users WHERE uid = ?", (uid,))
+        if not rows:
+            return None
+        return rows[0][0], {"uid": rows[0][1], "avps": json.loads(rows[0][2])}
+
+    def users_with(self, attr, value):
+        rows = self.query("SELECT u.username, u.uid, u.avps FROM user_attrs a JOIN users u ON u.username = a.username "
+                "WHERE a.name = ? AND a.value = ? ORDER BY u.username", (attr, value))
+        for username, uid, avps in rows:
+            yield username, {"uid": uid, "avps": json.loads(avps)}
+
+    # attribute-value pairs
+    def get_avps(self):
+        avps = {"user": {}, "obj": {}, "env": {}}
+        for type_, name, vals in self.query("SELECT type, name, vals FROM avps ORDER BY id"):
+            avps.setdefault(type_, {})[name] = json.loads(vals)
+        return avps
+
+    def set_avps(self, avps):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM avps")
+            for type_, attrs in avps.items():
+                self.conn.executemany("INSERT INTO avps (type, name, vals) VALUES (?, ?, ?)",
+                        [(type_, name, json.dumps(values)) for name, values in attrs.items()])
+
+    # policy
+    def get_rules(self):
+        return [json.loads(rule) for (rule,) in self.query("SELECT rule FROM rules ORDER BY id")]
+
+    def set_rules(self, rules):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM rules")
+            self.conn.executemany("INSERT INTO rules (rule) VALUES (?)", [(json.dumps(rule),) for rule in rules])
+
+    def add_rules(self, rules):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO rules (rule) VALUES (?)", [(json.dumps(rule),) for rule in rules])
+
+# store shared by all the commands of this process
+store = None
+
+def backend_name():
+    """The configured backend. 'auto' selects sqlite once the json config has been migrated"""
+    if STORE_BACKEND != "auto":
+        return STORE_BACKEND
+    return "sqlite" if Path(CONFIG_ROOT + CONFIG_DB_FILE).is_file() else "json"
+
+def get_store():
+    global store
+    if store is None:
+        name = backend_name()
+        if name == "sqlite":
+            store = SQLiteStore()
+        elif name == "json":
+            store = JSONStore()
+        else:
+            sys.exit(f"Unknown ABAC store backend {name}")
+    return store
@@ -10,10 +10,15 @@ import getpass
 import click
 import crypt
 import json
+import time
+from itertools import islice
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from .load import load_user_attr
-from .config import CONFIG_ROOT, CONFIG_USER_ATTRS_FILE, CONFIG_AVP_FILE
-from .common import check_root, validate_str
+from .store import get_store
+from .config import CONFIG_ROOT, CONFIG_USER_ATTRS_FILE, CONFIG_AVP_FILE, USER_IMPORT_WORKERS, USER_IMPORT_RETRIES
+from .common import check_root, validate_str, read_records, parse_csv_avps, parse_avps
 
 user_attr_path = CONFIG_ROOT + CONFIG_USER_ATTRS_FILE
 avp_path = CONFIG_ROOT + CONFIG_AVP_FILE 
@@ -38,23 +43,36 @@ def verify_user_attr_initialized():
 
 def abac_group_created():
     # check if the 'abac' user group is created
-    if not 'abac' in [g.gr_name for g in grp.getgrall()]:
+    try:
+        grp.getgrnam('abac')
+    except KeyError:
         sys.exit("'abac' group not found. Please create this group before adding users. Users will be added to this group")
 
 
+def system_users():
+    """{name: uid} of the users enumerated by the passwd database"""
+    return {p.pw_name: p.pw_uid for p in pwd.getpwall()}
+
+def system_uid(username, snapshot):
+    """
+    uid of username, or None if it is not a user of the system. Directory users (sssd, LDAP)
+    are usually not enumerated, so the names missing from the snapshot are looked up
+    """
+    if username in snapshot:
+        return snapshot[username]
+    try:
+        return pwd.getpwnam(username).pw_uid
+    except KeyError:
+        return None
+
 def user_attr_exists(username):
-    with open(user_attr_path) as f:
-        users = json.load(f)["users"]
-        if username in users:
-            return True
-    return False
+    return get_store().get_user(username) is not None
 
 def add_user(username):
     """
     Attempts to add a new user into the system and populate the user attribute file
     """
-    with open(avp_path) as f:
-        available_avps = json.load(f)['user']
+    available_avps = get_store().get_avps()['user']
     if len(available_avps.keys()) == 0:
         sys.exit("User attribute value pairs not initialized.")
     if user_attr_exists(username):
@@ -90,11 +108,7 @@ def add_user(username):
         data = {}
         data['uid'] = uid
         data['avps'] = selected_avps
-        with open(user_attr_path, 'r') as f:
-            users = json.load(f)
-            users['users'][username] = data
-        with open(user_attr_path, 'w') as f:
-            json.dump(users, f)
+        get_store().set_user(username, data)
         print(f"User attributes written to config successfully.")
         load_user_attr()
     except Exception as e:
@@ -102,17 +116,132 @@ def add_user(username):
         print(f"Failed to add abac user.")
         sys.exit(1)
 
+def parse_user_record(record, csv_format, value_sets):
+    """(username, avps, encrypted password) of an imported record. Raises ValueError if it is invalid"""
+    username = str(record.get("name", "")).strip()
+    if not validate_str(username):
+        raise ValueError(f"invalid username '{username}'. Username must be an alpha numeric")
+    avps = record.get("attrs", {})
+    if csv_format:
+        avps = parse_csv_avps(avps or "")
+    if not isinstance(avps, dict) or len(avps) == 0:
+        raise ValueError("atleast one attribute must be assigned")
+    for name, value in avps.items():
+        if name not in value_sets:
+            raise ValueError(f"unknown attribute {name}")
+        if value not in value_sets[name]:
+            raise ValueError(f"invalid value {value} for attribute {name}")
+    # accounts without a password hash are created locked
+    password = record.get("password") or "!"
+    locked = record.get("locked", False)
+    if locked is True or str(locked).lower() in ("true", "yes", "1"):
+        password = "!"
+    return username, avps, password
+
+def create_account(username, enc_password):
+    """Run useradd, retrying while another useradd holds the passwd/group lock. Returns the error or None"""
+    for attempt in range(USER_IMPORT_RETRIES):
+        p = Popen(["useradd", "-m", "-G", "abac", "-p", enc_password, username], stdout=PIPE, stderr=PIPE)
+        output, error = p.communicate()
+        if p.returncode == 0:
+            return None
+        error = error.decode('utf-8').strip()
+        if "lock" not in error:
+            break
+        time.sleep(0.1 * (attempt + 1))
+    return error
+
+def import_users(path, workers, progress_path):
+    """
+    Create the accounts of the users in the file with a pool of workers, then write
+    their attributes and reload the kernel once. Users created are appended to the
+    progress file, so an interrupted import can be run again and skips them
+    """
+    store = get_store()
+    value_sets = {name: set(values) for name, values in store.get_avps()["user"].items()}
+    csv_format = path.lower().endswith(".csv")
+    if progress_path is None:
+        progress_path = path + ".progress"
+    done = set()
+    if Path(progress_path).is_file():
+        with open(progress_path) as f:
+            done = set(line.strip() for line in f if line.strip() != "")
+        print(f"Resuming import: {len(done)} users already created")
+    # one snapshot of the passwd database and the store, instead of a lookup per user
+    snapshot = system_users()
+    abac_users = set(username for username, _ in store.iter_users())
+
+    users = {}
+    to_create = []
+    errors = 0
+    for line_number, record, error in read_records(path):
+        if record is not None:
+            try:
+                username, avps, password = parse_user_record(record, csv_format, value_sets)
+                if username in users:
+                    error = f"user {username} repeated"
+                elif username not in done and username in abac_users:
+                    error = f"user {username} already exists in ABAC config"
+                elif username not in done and system_uid(username, snapshot) is not None:
+                    error = f"user {username} already exists in the system"
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            print(f"{path}:{line_number}: {error}")
+            errors += 1
+            continue
+        users[username] = avps
+        if username not in done:
+            to_create.append((line_number, username, password))
+
+    progress_lock = threading.Lock()
+    failed = set()
+    with open(progress_path, "a") as progress:
+        def provision(line_number, username, password):
+            try:
+                error = create_account(username, password)
+            except OSError as e:
+                error = str(e)
+            with progress_lock:
+                if error is not None:
+                    print(f"{path}:{line_number}: failed to add user {username}: {error}")
+                    failed.add(username)
+                    return
+                progress.write(username + "\n")
+                progress.flush()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for line_number, username, password in to_create:
+                pool.submit(provision, line_number, username, password)
+    errors += len(failed)
+
+    snapshot = system_users()
+    updates = {}
+    for username, avps in users.items():
+        if username in failed:
+            continue
+        uid = system_uid(username, snapshot)
+        if uid is None:
+            print(f"user {username} not found in the system after it was created")
+            errors += 1
+            continue
+        updates[username] = {"uid": uid, "avps": avps}
+    if len(updates) != 0:
+        store.update_users(updates)
+        print(f"{len(updates)} users imported")
+        load_user_attr()
+    if errors != 0:
+        sys.exit(f"{errors} users could not be imported. Fix them and run the import again to resume")
+    os.remove(progress_path)
+
 def manage_user(username):
     '''
     Modify user attributes
     '''
-    with open(user_attr_path) as f:
-        users = json.load(f)
-        if username not in users["users"]:
-            sys.exit(f"User {username} doesn't have any attributes")
-        user = users['users'][username]
-    with open(avp_path) as f:
-        available_avps = json.load(f)['user']
+    store = get_store()
+    user = store.get_user(username)
+    if user is None:
+        sys.exit(f"User {username} doesn't have any attributes")
+    available_avps = store.get_avps()['user']
     print(f"Attribute-Value pairs of user : {username}")
     for i, (name, value) in enumerate(user['avps'].items()):
         print(f"[{i}] {name} = {value}")
@@ -149,9 +278,7 @@ def manage_user(username):
         if name not in user['avps']:
             sys.exit("Invalid attribute name.")
         del user['avps'][name]
-    users['users'][username] = user
-    with open(user_attr_path, 'w') as f:
-        json.dump(users, f)
+    store.set_user(username, user)
     load_user_attr()
     print("Success")
 
@@ -173,29 +300,34 @@ def delete_user(username):
         print(e)
         print(f"Failed to delete user {username}.")
     # delete user data from user_attrs
-    with open(user_attr_path) as f:
-        users = json.load(f)
-        if username not in users["users"]:
-            sys.exit(f"user {username} not found in config")
-    del users["users"][username]
-    with open(user_attr_path, 'w') as f:
-        json.dump(users, f)
+    if not get_store().delete_user(username):
+        sys.exit(f"user {username} not found in config")
     print(f"user {username} deleted successfully\n")
     print("Reloading user attributes into the kernel")
     load_user_attr()
 
-def list_users():
+def list_users(where=(), as_json=False, limit=None, offset=0):
     '''
-    List users and their attribute-value pairs 
+    List users and their attribute-value pairs, optionally only those holding all the
+    where attribute-value pairs, from offset and at most limit of them
     '''
-    with open(user_attr_path) as f:
-        users = json.load(f)["users"]
-    for i, (username, userdata) in enumerate(users.items()):
-        deleted = False
-        try:
-            uid_sys = pwd.getpwnam(username).pw_uid
-        except KeyError:
-            deleted = True
+    store = get_store()
+    where = parse_avps(where)
+    if len(where) == 0:
+        users = store.iter_users()
+    else:
+        # look up the users holding the first pair, and filter them on the others
+        attr, value = next(iter(where.items()))
+        users = (u for u in store.users_with(attr, value)
+                if all(u[1]['avps'].get(n) == v for n, v in where.items()))
+    # one snapshot of the passwd database, instead of a lookup per user
+    snapshot = system_users()
+    stop = None if limit is None else offset + limit
+    for i, (username, userdata) in enumerate(islice(users, offset, stop), offset):
+        deleted = system_uid(username, snapshot) is None
+        if as_json:
+            print(json.dumps({"name": username, "uid": userdata['uid'], "avps": userdata['avps'], "deleted": deleted}))
+            continue
         avps = []
         for name, value in userdata['avps'].items():
             avps.append(f"{name} = {value}")
@@ -203,9 +335,15 @@ def list_users():
         print(f"[{i}] {username} : {uid} : {','.join(avps)} {'[user deleted from system]' if deleted else ''}")
 
 @click.command()
-@click.argument('action', type=click.Choice(['add', 'manage', 'list', 'delete']))
+@click.option('-w', '--workers', 'workers', type=click.IntRange(1, 64), default=USER_IMPORT_WORKERS, help='import: number of accounts created in parallel.')
+@click.option('--progress', 'progress', type=click.Path(dir_okay=False), default=None, help='import: progress file of a resumable import. Defaults to FILE.progress.')
+@click.option('--where', 'where', multiple=True, help='list: only users with this attribute-value pair (attr=value). Can be repeated.')
+@click.option('--json', 'as_json', default=False, is_flag=True, help='list: print one json object per user.')
+@click.option('--limit', 'limit', type=click.IntRange(min=0), default=None, help='list: print at most this many users.')
+@click.option('--offset', 'offset', type=click.IntRange(min=0), default=0, help='list: skip this many users.')
+@click.argument('action', type=click.Choice(['add', 'manage', 'list', 'delete', 'import']))
 @click.argument('username', type=str, required=False)
-def user(action, username):
+def user(action, username, workers, progress, where, as_json, limit, offset):
     """\b
     Manage ABAC User attributes. YOU MUST BE ROOT TO USE THIS COMMAND
 
@@ -213,14 +351,23 @@ def user(action, username):
     add     - Create a new user and add attributes
     manage  - Mange an existing user's attributes
     list    - List abac users and their attributes
-    delete  - Delete a user and corresponding attributes"""
+    delete  - Delete a user and corresponding attributes
+    import  - Create the users of a JSON lines file, or of a CSV file (.csv) with the
+              columns name,attrs,password,locked: abac user import FILE
+              JSON lines: {"name": "alice", "attrs": {"dept": "hr"}, "password": "<crypt hash>"}
+              CSV       : alice,dept=hr ^ level=2,<crypt hash>,false
+              Users without a password hash are created locked"""
 
     check_root()
     verify_user_attr_initialized()
     abac_group_created()
 
     if action == 'list':
-        list_users()
+        list_users(where, as_json, limit, offset)
+    elif action == 'import':
+        if username is None or not Path(username).is_file():
+            sys.exit("Usage: abac user import FILE")
+        import_users(username, workers, progress)
     elif not validate_str(username):
         sys.exit("invalid username. Username must be an alpha numeric")
     elif action == 'add':
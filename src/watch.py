@@ -1,44 +1,247 @@
 # ABAC Shared Directory watch
 # Copyright (C) 2021 Hariyala Omakara Naga Sai Varshith
 
+import os
+import stat
+import errno
 import time
+import queue
+import threading
 import click
-import json
-from subprocess import Popen, PIPE
 from pathlib import Path
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from .common import check_root
-from .config import SHARED_DIR, CONFIG_ROOT, CONFIG_OBJ_ATTRS_FILE
-from .load import load_obj_attr
+from .config import SHARED_DIR, SHARED_DIR_MODE, WATCH_QUEUE_SIZE, WATCH_BATCH_SIZE
+from .obj import reload_obj_attr
+from .store import get_store, is_under
+from .reload import ReloadScheduler
+from .inherit import inherited_avps, trees
 
 watch_dir = str(Path(SHARED_DIR).resolve())
 
+# directories are opened readable, so that they can be listed and fchmod-ed
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+
+def set_mode(fd):
+    """fchmod the directory open at fd to SHARED_DIR_MODE unless it already has it"""
+    if os.fstat(fd).st_mode & 0o7777 != SHARED_DIR_MODE:
+        os.fchmod(fd, SHARED_DIR_MODE)
+
+def set_mode_at(name, dir_fd):
+    """
+    chmod name, in the directory open at dir_fd, to SHARED_DIR_MODE without following
+    symlinks. Returns an fd of name if it is a directory, which the caller closes
+    """
+    try:
+        fd = os.open(name, DIR_FLAGS, dir_fd=dir_fd)
+    except FileNotFoundError:
+        # removed before the event was processed
+        return None
+    except OSError as e:
+        # ENOTDIR for files and symlinks, ELOOP for symlinks on some systems
+        if e.errno not in (errno.ENOTDIR, errno.ELOOP):
+            raise
+    else:
+        set_mode(fd)
+        return fd
+    try:
+        fd = os.open(name, os.O_PATH | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return None
+    try:
+        st = os.fstat(fd)
+        if stat.S_ISLNK(st.st_mode) or st.st_mode & 0o7777 == SHARED_DIR_MODE:
+            return None
+        # O_PATH descriptors can't be fchmod-ed. Their /proc link leads to the opened
+        # inode itself, whatever the path now points to
+        os.chmod(f"/proc/self/fd/{fd}", SHARED_DIR_MODE)
+        return None
+    finally:
+        os.close(fd)
+
+def set_tree_mode(top_fd):
+    """Apply SHARED_DIR_MODE to everything below the directory open at top_fd"""
+    # directories being listed, one per level. Only the open fds of the current branch are kept
+    stack = [(top_fd, iter(os.listdir(top_fd)))]
+    try:
+        while len(stack) != 0:
+            dir_fd, names = stack[-1]
+            name = next(names, None)
+            if name is None:
+                stack.pop()
+                if dir_fd != top_fd:
+                    os.close(dir_fd)
+                continue
+            fd = set_mode_at(name, dir_fd)
+            if fd is not None:
+                stack.append((fd, iter(os.listdir(fd))))
+    finally:
+        for dir_fd, _ in stack:
+            if dir_fd != top_fd:
+                os.close(dir_fd)
+
+def fix_permissions(path):
+    """
+    Apply SHARED_DIR_MODE to a path created in the shared directory, to the directories
+    between it and the shared directory, and to the contents of a directory moved in.
+    Users of the shared directory can replace any of these paths with a symlink, so every
+    path is opened relative to its parent directory, and symlinks are never followed.
+    """
+    rel = os.path.relpath(path, watch_dir)
+    if rel == "." or rel == ".." or rel.startswith("../"):
+        return
+    names = rel.split("/")
+    fd = os.open(watch_dir, DIR_FLAGS)
+    try:
+        set_mode(fd)
+        for name in names[:-1]:
+            try:
+                child = os.open(name, DIR_FLAGS, dir_fd=fd)
+            except OSError as e:
+                # removed, or replaced with a symlink or a file, since the event
+                if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.ELOOP):
+                    return
+                raise
+            os.close(fd)
+            fd = child
+            set_mode(fd)
+        child = set_mode_at(names[-1], fd)
+        if child is not None:
+            try:
+                set_tree_mode(child)
+            finally:
+                os.close(child)
+    finally:
+        os.close(fd)
+
+class ObjectChanges:
+    """
+    Deletions and renames of objects made by a batch of events. The subtree operations of
+    the store collect them as pending updates, so later events of the batch see the changes
+    of the earlier ones, and all changes are written with one store update
+    """
+
+    def __init__(self, store, dirs):
+        self.store = store
+        self.updates = {}
+        # directory attributes, updated in place by the events of the batch
+        self.dirs = dict(dirs)
+        self.dirs_changed = False
+        self.deleted = 0
+        self.moved = 0
+
+    def dirs_under(self, path):
+        return [d for d in self.dirs if is_under(d, path)]
+
+    def delete(self, path, is_directory):
+        self.deleted += self.store.delete_prefix(path, self.updates)
+        if is_directory:
+            for d in self.dirs_under(path):
+                del self.dirs[d]
+                self.dirs_changed = True
+
+    def move(self, src, dest, is_directory):
+        self.moved += self.store.rename_prefix(src, dest, self.updates)
+        if is_directory:
+            moved = {d: self.dirs.pop(d) for d in self.dirs_under(src)}
+            for d, avps in moved.items():
+                self.dirs[dest + d[len(src):]] = avps
+                self.dirs_changed = True
+
+    def apply(self):
+        """Write the changes to the store. Returns True if there were any"""
+        if self.dirs_changed:
+            old = self.store.get_dirs()
+            for path in old:
+                if path not in self.dirs:
+                    self.store.set_dir(path, {})
+            for path, avps in self.dirs.items():
+                if old.get(path) != avps:
+                    self.store.set_dir(path, avps)
+        if len(self.updates) != 0:
+            self.store.update_objs(self.updates)
+        return len(self.updates) != 0 or self.dirs_changed
+
+def resolve(path):
+    return str(Path(path).resolve())
+
 class Handler(FileSystemEventHandler):
-    @staticmethod
-    def on_any_event(event):
-        if event.event_type == 'created':
-            p = Popen(["chmod", "-R" , "3770", watch_dir], stdout=PIPE, stderr=PIPE)
-            output, error = p.communicate()
-            if p.returncode != 0: 
-                print(f"Failed to chmod for {event.src_path}")
-        if event.event_type == "deleted":
-            # check if the deleted object has attributes, delete these attributes from config and reload
-            with open(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE) as f:
-                attrs = json.load(f)
-            if str(Path(event.src_path).resolve()) in attrs["objects"]:
-                del attrs["objects"][event.src_path]
-                print(f"Deleted attributes for file {event.src_path}")
-            with open(CONFIG_ROOT + CONFIG_OBJ_ATTRS_FILE, 'w') as f:
-                json.dump(attrs, f)
-            load_obj_attr()
+    """
+    Queues the events of the shared directory. A single worker thread processes them in
+    batches of the events queued meanwhile, so bursts of events never run concurrently,
+    the queue bounds the backlog and each batch writes the store and reloads once
+    """
+
+    def __init__(self, reloads, size=WATCH_QUEUE_SIZE, batch_size=WATCH_BATCH_SIZE):
+        super().__init__()
+        self.reloads = reloads
+        self.batch_size = batch_size
+        self.events = queue.Queue(maxsize=size)
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def on_any_event(self, event):
+        if event.event_type in ("created", "deleted", "moved"):
+            self.events.put(event)
+
+    def work(self):
+        while True:
+            batch = [self.events.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.process(batch)
+            except Exception as e:
+                print(f"Failed to process a batch of {len(batch)} events\n{e}")
+            finally:
+                for _ in batch:
+                    self.events.task_done()
+
+    def process(self, batch):
+        store = get_store()
+        # files created, deleted or moved below a directory with attributes change
+        # the inherited entries loaded into the kernel
+        dirs = store.get_dirs()
+        changes = ObjectChanges(store, dirs)
+        inherited = False
+        for event in batch:
+            if len(dirs) != 0:
+                for path in {event.src_path, getattr(event, "dest_path", event.src_path)}:
+                    path = resolve(path)
+                    if inherited_avps(path, dirs):
+                        # list the changed directories again on the next load
+                        trees.invalidate(path)
+                        inherited = True
+            if event.event_type == 'created':
+                try:
+                    fix_permissions(event.src_path)
+                except OSError as e:
+                    print(f"Failed to chmod for {event.src_path}\n{e}")
+            elif event.event_type == "deleted":
+                # remove the attributes of the deleted object, or of the objects of a deleted directory
+                changes.delete(resolve(event.src_path), event.is_directory)
+            elif event.event_type == "moved":
+                # the attributes follow the object, or the objects of a moved directory
+                changes.move(resolve(event.src_path), resolve(event.dest_path), event.is_directory)
+        changed = changes.apply()
+        if changed:
+            print(f"Deleted attributes of {changes.deleted} objects, moved attributes of {changes.moved} objects")
+        if changed or inherited:
+            # deleting or moving a directory tree changes many objects. Reload once for all of them
+            self.reloads.request()
 
 class ABACWatcher:
     def __init__(self):
         self.observer = Observer()
+        # reloads go through the attribute server while it runs, so they don't race its own
+        self.reloads = ReloadScheduler(reload_obj_attr)
 
     def run(self):
-        event_handler = Handler()
+        event_handler = Handler(self.reloads)
         self.observer.schedule(event_handler, watch_dir, recursive=True)
         self.observer.start()
         try:
@@ -59,5 +262,6 @@ def watch():
     Runs as a system service in the background.
     """
     check_root()
+    get_store().recover()
     w = ABACWatcher()
     w.run()